@@ -0,0 +1,53 @@
+# Общие помощники микробенчмарков: замеры, сводка, запись результатов в JSON.
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except Exception:
+        return 'unknown'
+
+def summarize(samples):
+    ordered = sorted(samples)
+    def pct(q):
+        return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+    return {
+        'ops': len(ordered),
+        'mean_us': round(statistics.fmean(ordered) * 1e6, 3),
+        'p50_us': round(pct(50) * 1e6, 3),
+        'p99_us': round(pct(99) * 1e6, 3),
+    }
+
+async def time_async(func, args_iter):
+    # Замер каждого вызова по отдельности: func(*args) для каждого набора аргументов
+    samples = []
+    for args in args_iter:
+        started = time.perf_counter()
+        await func(*args)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def write_results(suite, results, path=None, params=None):
+    report = {
+        'suite': suite,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'params': params or {},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+    return report
+
+def print_results(results):
+    width = max(len(name) for name in results)
+    print(f"{'benchmark':<{width}} {'ops':>8} {'mean, us':>12} {'p50, us':>12} {'p99, us':>12}")
+    for name, r in results.items():
+        print(f"{name:<{width}} {r['ops']:>8} {r['mean_us']:>12.2f} {r['p50_us']:>12.2f} {r['p99_us']:>12.2f}")
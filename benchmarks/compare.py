@@ -0,0 +1,51 @@
+# Сравнение двух JSON-результатов бенчмарков (например, двух коммитов).
+# Запуск: python -m benchmarks.compare old.json new.json [--threshold 10] [--metric p50_us]
+# Код возврата 1, если хоть один бенчмарк замедлился сильнее порога.
+import argparse
+import json
+import sys
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compare(old, new, metric, threshold):
+    rows = []
+    regressions = 0
+    for name in sorted(set(old['results']) | set(new['results'])):
+        before = old['results'].get(name, {}).get(metric)
+        after = new['results'].get(name, {}).get(metric)
+        if before is None or after is None:
+            rows.append((name, before, after, None, 'only in ' + ('new' if before is None else 'old')))
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        status = ''
+        if change > threshold:
+            status = 'REGRESSION'
+            regressions += 1
+        elif change < -threshold:
+            status = 'improved'
+        rows.append((name, before, after, change, status))
+    return rows, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Diff two benchmark result files')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--metric', default='mean_us', choices=['mean_us', 'p50_us', 'p99_us'])
+    parser.add_argument('--threshold', type=float, default=10.0, help='allowed slowdown, %%')
+    args = parser.parse_args()
+
+    old, new = load(args.old), load(args.new)
+    rows, regressions = compare(old, new, args.metric, args.threshold)
+    print(f"{old['suite']}: {old['commit']} -> {new['commit']} ({args.metric}, threshold {args.threshold}%)")
+    width = max((len(r[0]) for r in rows), default=10)
+    for name, before, after, change, status in rows:
+        if change is None:
+            print(f"{name:<{width}} {'':>12} {'':>12} {'':>9}  {status}")
+        else:
+            print(f"{name:<{width}} {before:>12.2f} {after:>12.2f} {change:>+8.1f}%  {status}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
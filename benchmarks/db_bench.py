@@ -0,0 +1,143 @@
+# Микробенчмарки функций database.py на засеянном локальном PostgreSQL.
+# По умолчанию: 1M пользователей, 10M строк chat_logs (--scale уменьшает объём пропорционально).
+#
+# Запуск из корня репозитория:
+#   python -m benchmarks.db_bench --database-url postgresql://localhost/chatbot_bench --seed --json db.json
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import timedelta
+
+from benchmarks.common import summarize, time_async, write_results, print_results
+
+USERS = 1_000_000
+CHAT_LOGS = 10_000_000
+BANS = 1_000
+REPORTS = 100_000
+
+async def seed(conn, users, chat_logs, bans, reports):
+    started = time.perf_counter()
+    await conn.execute('TRUNCATE users, chat_logs, chat_logs_daily, bans, reports, user_stats, search_queue')
+    # Логи раскиданы по последнему году — нужны месячные секции под них
+    await conn.execute('''
+        SELECT create_chat_logs_partition(month::date)
+        FROM generate_series(date_trunc('month', NOW() - INTERVAL '365 days'), date_trunc('month', NOW()),
+                             INTERVAL '1 month') AS month
+    ''')
+    await conn.execute('''
+        INSERT INTO users (tg_id, state, last_active, created_at)
+        SELECT g,
+               CASE WHEN g % 50 = 0 THEN 'chat' WHEN g % 97 = 0 THEN 'searching' ELSE 'menu' END,
+               NOW() - (g % 100000) * INTERVAL '1 minute',
+               NOW() - (g % 1000) * INTERVAL '1 day'
+        FROM generate_series(1, $1::bigint) g
+    ''', users)
+    # Пачками, чтобы не держать одну огромную транзакцию
+    step = 1_000_000
+    for offset in range(0, chat_logs, step):
+        await conn.execute('''
+            INSERT INTO chat_logs (user_id, partner_id, duration, ended_at)
+            SELECT 1 + (random() * ($1::bigint - 1))::bigint,
+                   1 + (random() * ($1::bigint - 1))::bigint,
+                   random() * INTERVAL '30 minutes',
+                   NOW() - random() * INTERVAL '365 days'
+            FROM generate_series(1, $2::bigint)
+        ''', users, min(step, chat_logs - offset))
+    await conn.execute('''
+        INSERT INTO bans (tg_id, until)
+        SELECT g * ($1::bigint / $2::bigint), NOW() + INTERVAL '1 day'
+        FROM generate_series(1, $2::bigint) g
+    ''', users, bans)
+    await conn.execute('''
+        INSERT INTO reports (from_id, to_id, reason, timestamp)
+        SELECT 1 + (random() * ($1::bigint - 1))::bigint,
+               1 + (random() * ($1::bigint - 1))::bigint,
+               'seeded report',
+               NOW() - random() * INTERVAL '90 days'
+        FROM generate_series(1, $2::bigint)
+    ''', users, reports)
+    await conn.execute('''
+        INSERT INTO user_stats (user_id, chat_count, total_seconds, last_chat)
+        SELECT user_id, COUNT(*), SUM(EXTRACT(EPOCH FROM duration)), MAX(ended_at)
+        FROM chat_logs GROUP BY user_id
+    ''')
+    await conn.execute('ANALYZE')
+    print(f"Seeded {users} users / {chat_logs} chat_logs in {time.perf_counter() - started:.1f}s")
+
+async def run(args):
+    os.environ['DATABASE_URL'] = args.database_url
+    import database
+
+    await database.init_db()
+    users = int(USERS * args.scale)
+    if args.seed:
+        async with database.pool.acquire() as conn:
+            await seed(conn, users, int(CHAT_LOGS * args.scale), max(int(BANS * args.scale), 1),
+                       int(REPORTS * args.scale))
+        await database.load_bans()
+    else:
+        async with database.pool.acquire() as conn:
+            users = await conn.fetchval('SELECT COALESCE(MAX(tg_id), 1) FROM users')
+
+    rng = random.Random(args.random_seed)
+    def ids(n):
+        return [(rng.randint(1, users),) for _ in range(n)]
+
+    n = args.iterations
+    results = {}
+
+    # get_user: промах кэша (запрос в БД) и попадание
+    cache_size = database.user_cache.max_size
+    database.user_cache.max_size = 0
+    results['get_user/db'] = await time_async(database.get_user, ids(n))
+    database.user_cache.max_size = cache_size
+    hot = ids(100)
+    for (tg_id,) in hot:
+        await database.get_user(tg_id)
+    results['get_user/cached'] = await time_async(database.get_user, hot * (n // 100 or 1))
+
+    async def touch(tg_id):
+        await database.update_user(tg_id, state='menu')
+    results['update_user'] = await time_async(touch, ids(n))
+
+    # is_banned: индекс в памяти и запасной путь через БД
+    results['is_banned/index'] = await time_async(database.is_banned, ids(n))
+    database.ban_index.loaded = False
+    results['is_banned/db'] = await time_async(database.is_banned, ids(n))
+    database.ban_index.loaded = True
+
+    # log_chat_end: постановка в буфер плюс амортизированный сброс пачкой
+    pairs = [(a, b) for (a,), (b,) in zip(ids(n), ids(n))]
+    started = time.perf_counter()
+    samples = []
+    for a, b in pairs:
+        t = time.perf_counter()
+        await database.log_chat_end(a, b, timedelta(minutes=3))
+        samples.append(time.perf_counter() - t)
+    results['log_chat_end/enqueue'] = summarize(samples)
+    await database.write_buffer.flush()
+    elapsed = time.perf_counter() - started
+    results['log_chat_end/amortized'] = dict(summarize([elapsed / len(pairs)]), ops=len(pairs))
+
+    results['get_user_chat_stats'] = await time_async(database.get_user_chat_stats, ids(n))
+
+    await database.close_db()
+    print_results(results)
+    write_results('db', results, args.json, {
+        'scale': args.scale, 'users': users, 'iterations': n, 'random_seed': args.random_seed,
+    })
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='database.py micro-benchmarks against a seeded Postgres')
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL', 'postgresql://localhost/chatbot_bench'))
+    parser.add_argument('--seed', action='store_true', help='truncate and re-seed the bench tables first')
+    parser.add_argument('--scale', type=float, default=1.0, help='fraction of the 1M users / 10M chat_logs data set')
+    parser.add_argument('--iterations', type=int, default=2_000)
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
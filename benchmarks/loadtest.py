@@ -0,0 +1,303 @@
+# Сквозной нагрузочный тест: приложение из main.py + локальный PostgreSQL + заглушка Bot API.
+# Заглушка записывает вызовы и по желанию отвечает 429 (RetryAfter).
+#
+# Запуск из корня репозитория:
+#   python -m benchmarks.loadtest --database-url postgresql://localhost/chatbot_bench --users 2000 --reset
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+FOUND_TEXT = "Собеседник найден"
+BOT_TOKEN = "123456:LOADTEST"
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+class BotApiStub:
+    # Поддельный Bot API: принимает любые методы, отвечает минимально валидными объектами
+    def __init__(self, rate_limit_ratio=0.0, retry_after=1):
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = 0
+        self._message_ids = itertools.count(1)
+        self._waiters = {}
+        self._runner = None
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def expect(self, chat_id, substring):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append((substring, future))
+        return future
+
+    def _message(self, chat_id):
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        data = await request.post()
+        self.calls[method] += 1
+        if method.startswith('send') and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        chat_id = int(data.get('chat_id', 0) or 0)
+        if method == 'sendMessage':
+            text = data.get('text', '')
+            waiters = self._waiters.get(chat_id)
+            if waiters:
+                for item in list(waiters):
+                    substring, future = item
+                    if substring in text:
+                        waiters.remove(item)
+                        if not future.done():
+                            future.set_result(time.perf_counter())
+        if method == 'sendMediaGroup':
+            media = json.loads(data.get('media', '[]'))
+            result = [self._message(chat_id) for _ in media]
+        elif method.startswith('send') or method.startswith('edit'):
+            result = self._message(chat_id)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+class SimUser:
+    _update_ids = itertools.count(1)
+    _message_ids = itertools.count(1)
+    _group_ids = itertools.count(1)
+
+    def __init__(self, user_id, http, webhook_url, stats):
+        self.user_id = user_id
+        self.http = http
+        self.webhook_url = webhook_url
+        self.stats = stats
+
+    async def send(self, **content):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+            'from': {'id': self.user_id, 'is_bot': False, 'first_name': f'u{self.user_id}'},
+        }
+        message.update(content)
+        update = {'update_id': next(self._update_ids), 'message': message}
+        started = time.perf_counter()
+        async with self.http.post(self.webhook_url, json=update) as response:
+            await response.read()
+            self.stats['http_status'][response.status] += 1
+        self.stats['http_latency'].append(time.perf_counter() - started)
+        self.stats['updates'] += 1
+
+    async def send_text(self, text):
+        await self.send(text=text)
+
+    async def send_random_content(self):
+        kind = random.choices(
+            ['text', 'photo', 'sticker', 'voice', 'video', 'document', 'album'],
+            weights=[70, 10, 8, 4, 3, 3, 2],
+        )[0]
+        file_id = f'file-{random.randrange(10**9)}'
+        if kind == 'text':
+            await self.send(text=f'hello {random.randrange(10**6)}')
+        elif kind == 'photo':
+            await self.send(photo=[{'file_id': file_id, 'file_unique_id': file_id, 'width': 90, 'height': 90}])
+        elif kind == 'sticker':
+            await self.send(sticker={
+                'file_id': file_id, 'file_unique_id': file_id, 'type': 'regular',
+                'width': 512, 'height': 512, 'is_animated': False, 'is_video': False,
+            })
+        elif kind == 'voice':
+            await self.send(voice={'file_id': file_id, 'file_unique_id': file_id, 'duration': 3})
+        elif kind == 'video':
+            await self.send(video={
+                'file_id': file_id, 'file_unique_id': file_id, 'width': 640, 'height': 360, 'duration': 5,
+            })
+        elif kind == 'document':
+            await self.send(document={'file_id': file_id, 'file_unique_id': file_id})
+        else:
+            group = f'group-{next(self._group_ids)}'
+            for i in range(random.randint(2, 4)):
+                part = f'{file_id}-{i}'
+                await self.send(media_group_id=group, photo=[
+                    {'file_id': part, 'file_unique_id': part, 'width': 90, 'height': 90}
+                ])
+        self.stats['content'][kind] += 1
+
+async def user_flow(user, stub, args):
+    stats = user.stats
+    await user.send_text('/start')
+    found = stub.expect(user.user_id, FOUND_TEXT)
+    for round_no in range(args.rounds):
+        searched_at = time.perf_counter()
+        await user.send_text('🔍 Найти собеседника')
+        try:
+            found_at = await asyncio.wait_for(found, timeout=args.pair_timeout)
+        except asyncio.TimeoutError:
+            stats['pair_timeouts'] += 1
+            await user.send_text('❌ Отмена поиска')
+            return
+        stats['pair_wait'].append(max(found_at - searched_at, 0.0))
+        for _ in range(args.messages):
+            await user.send_random_content()
+            await asyncio.sleep(random.uniform(0, args.think_time))
+        # Ожидание следующей пары регистрируем до выхода из чата: подбор может случиться сразу
+        found = stub.expect(user.user_id, FOUND_TEXT)
+        action = random.choices(['next', 'end', 'report'], weights=[70, 20, 10])[0]
+        stats['actions'][action] += 1
+        if action == 'next':
+            await user.send_text('➡️ Следующий')
+        elif action == 'end':
+            await user.send_text('⏹️ Завершить')
+        else:
+            await user.send_text('🚫 Пожаловаться')
+            await user.send_text('спам и флуд в чате')
+
+async def reset_database(database_url):
+    import asyncpg
+    conn = await asyncpg.connect(database_url)
+    try:
+        for table in ('users', 'reports', 'bans', 'chat_logs', 'chat_logs_daily', 'user_stats', 'search_queue'):
+            if await conn.fetchval('SELECT to_regclass($1)', table) is not None:
+                await conn.execute(f'TRUNCATE {table}')
+    finally:
+        await conn.close()
+
+async def run(args):
+    stub = BotApiStub(args.rate_limit_ratio, args.retry_after)
+    await stub.start(args.api_port)
+
+    if args.reset:
+        await reset_database(args.database_url)
+
+    # Окружение выставляем до импорта main: он читает его при импорте
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'DATABASE_URL': args.database_url,
+        'MODERATOR_ID': '1',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{args.api_port}',
+        'RENDER_SERVICE_NAME': 'loadtest',
+    })
+    import main
+    import instrumentation
+
+    update_latency = []
+
+    async def measure(handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            update_latency.append(time.perf_counter() - started)
+
+    main.dp.update.outer_middleware(measure)
+    runner = web.AppRunner(main.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.app_port).start()
+
+    stats = {
+        'updates': 0,
+        'http_latency': [],
+        'http_status': Counter(),
+        'pair_wait': [],
+        'pair_timeouts': 0,
+        'actions': Counter(),
+        'content': Counter(),
+    }
+    webhook_url = f'http://127.0.0.1:{args.app_port}/webhook'
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector) as http:
+        async def launch(index):
+            await asyncio.sleep(args.ramp * index / max(args.users, 1))
+            user = SimUser(args.first_user_id + index, http, webhook_url, stats)
+            await user_flow(user, stub, args)
+        await asyncio.gather(*(launch(i) for i in range(args.users)))
+    # Дожидаемся, пока отложенные апдейты и отправки дойдут до конца
+    await asyncio.sleep(args.settle)
+    elapsed = time.perf_counter() - started
+    db_queries = instrumentation.DB_QUERY_LATENCY.total()
+    await runner.cleanup()
+    await stub.stop()
+
+    result = {
+        'users': args.users,
+        'updates': stats['updates'],
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(stats['updates'] / elapsed, 1),
+        'update_latency_ms': {
+            'p50': round(percentile(update_latency, 50) * 1000, 2),
+            'p99': round(percentile(update_latency, 99) * 1000, 2),
+        },
+        'webhook_latency_ms': {
+            'p50': round(percentile(stats['http_latency'], 50) * 1000, 2),
+            'p99': round(percentile(stats['http_latency'], 99) * 1000, 2),
+        },
+        'pair_wait_s': {
+            'p50': round(percentile(stats['pair_wait'], 50), 3),
+            'p99': round(percentile(stats['pair_wait'], 99), 3),
+            'mean': round(statistics.fmean(stats['pair_wait']), 3) if stats['pair_wait'] else 0.0,
+            'timeouts': stats['pair_timeouts'],
+        },
+        'db_queries_per_update': round(db_queries / max(len(update_latency), 1), 2),
+        'http_status': dict(stats['http_status']),
+        'api_calls': dict(stub.calls),
+        'api_rate_limited': stub.rate_limited,
+        'actions': dict(stats['actions']),
+        'content': dict(stats['content']),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='End-to-end load test against a Bot API stub')
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL', 'postgresql://localhost/chatbot_bench'))
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=3, help='chats per simulated user')
+    parser.add_argument('--messages', type=int, default=10, help='messages per chat')
+    parser.add_argument('--think-time', type=float, default=0.2, help='max pause between messages, s')
+    parser.add_argument('--ramp', type=float, default=5.0, help='seconds to start all users')
+    parser.add_argument('--pair-timeout', type=float, default=30.0)
+    parser.add_argument('--settle', type=float, default=2.0)
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='share of send* calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--connections', type=int, default=200)
+    parser.add_argument('--first-user-id', type=int, default=10_000_000)
+    parser.add_argument('--app-port', type=int, default=18080)
+    parser.add_argument('--api-port', type=int, default=18081)
+    parser.add_argument('--reset', action='store_true', help='truncate bot tables before the run')
+    parser.add_argument('--json', help='also write the result to this file')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,173 @@
+# Симулятор подбора собеседников в виртуальном времени: поток пользователей с языком и
+# возрастной группой, чаты случайной длины, повторный поиск и уход из очереди по таймауту.
+# Сравнивает CriteriaMatchQueue и RandomMatchQueue по перцентилям ожидания и качеству пар.
+# Пары разбирает тот же цикл, что и в боте: wait_for_pair → drain_pairs. Цикл событий
+# работает на виртуальных часах, поэтому таймауты wait_for_pair срабатывают в свой срок, но без сна.
+#
+# Запуск из корня репозитория: python -m benchmarks.match_sim [--hours 2] [--json sim.json]
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import selectors
+from collections import Counter, deque
+
+from benchmarks.common import write_results
+from match_queue import CriteriaMatchQueue, RandomMatchQueue
+
+LANGUAGES = {'ru': 60, 'uk': 20, 'en': 15, None: 5}
+AGE_GROUPS = {'до 18': 10, '18-24': 35, '25-34': 20, '35+': 5, None: 30}
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def pick(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+class VirtualSelector:
+    # Вместо сна на таймауте select сдвигает виртуальные часы цикла событий
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        if timeout:
+            self.now += timeout
+        return self._selector.select(0)
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self._virtual = VirtualSelector()
+        super().__init__(self._virtual)
+
+    def time(self):
+        return self._virtual.now
+
+async def simulate(engine, args):
+    rng = random.Random(args.random_seed)
+    loop = asyncio.get_running_loop()
+    if engine == 'criteria':
+        queue = CriteriaMatchQueue(relax_after=args.relax_after, history=args.history, clock=loop.time)
+    else:
+        queue = RandomMatchQueue()
+
+    started = loop.time()
+    timers = []
+    def schedule(at, handler, user_id):
+        timers.append(loop.call_at(started + at, lambda: asyncio.ensure_future(handler(user_id))))
+
+    criteria = {}
+    history = {}
+    enqueued = {}
+    waits = []
+    stats = Counter()
+    end = args.hours * 3600
+
+    async def search(user_id):
+        if await queue.add(user_id, criteria[user_id]):
+            enqueued[user_id] = loop.time()
+            schedule(loop.time() - started + args.patience, give_up, user_id)
+
+    async def give_up(user_id):
+        # Отмена поиска, если пользователь всё ещё ждёт с той же постановки
+        if enqueued.get(user_id) is not None and loop.time() - enqueued[user_id] >= args.patience:
+            await queue.remove(user_id)
+            del enqueued[user_id]
+            stats['gave_up'] += 1
+
+    async def search_loop():
+        # Как start_search_loop в боте: просыпаемся по add() или по сроку ослабления критериев
+        while True:
+            await queue.wait_for_pair()
+            now = loop.time()
+            for user1, user2 in await queue.drain_pairs():
+                queue.matched(user1, user2)
+                stats['pairs'] += 1
+                if criteria[user1] == criteria[user2]:
+                    stats['strict'] += 1
+                elif criteria[user1][0] == criteria[user2][0]:
+                    stats['same_language'] += 1
+                if user2 in history.get(user1, ()):
+                    stats['repeats'] += 1
+                for a, b in ((user1, user2), (user2, user1)):
+                    history.setdefault(a, deque(maxlen=args.history or 1)).append(b)
+                    waits.append(now - enqueued.pop(a))
+                    if rng.random() < args.return_prob:
+                        schedule(now - started + rng.expovariate(1 / args.chat_seconds), search, a)
+            stats['wakeups'] += 1
+
+    # Новые пользователи — пуассоновский поток
+    t, user_ids = 0.0, itertools.count(1)
+    while t < end:
+        t += rng.expovariate(args.arrival_rate)
+        user_id = next(user_ids)
+        criteria[user_id] = (pick(rng, LANGUAGES), pick(rng, AGE_GROUPS))
+        schedule(t, search, user_id)
+
+    matcher = asyncio.create_task(search_loop())
+    await asyncio.sleep(end)
+    matcher.cancel()
+    for timer in timers:
+        timer.cancel()
+    await asyncio.gather(matcher, return_exceptions=True)
+
+    pairs = max(stats['pairs'], 1)
+    return {
+        'matched_users': len(waits),
+        'gave_up': stats['gave_up'],
+        'still_waiting': len(enqueued),
+        'wait_s': {
+            'p50': round(percentile(waits, 50), 2),
+            'p90': round(percentile(waits, 90), 2),
+            'p99': round(percentile(waits, 99), 2),
+            'max': round(max(waits, default=0.0), 2),
+        },
+        'strict_share': round(stats['strict'] / pairs, 3),
+        'same_language_share': round((stats['strict'] + stats['same_language']) / pairs, 3),
+        'repeat_share': round(stats['repeats'] / pairs, 4),
+        'wakeups': stats['wakeups'],
+    }
+
+async def run(args):
+    logging.disable(logging.INFO)
+    results = {}
+    for engine in args.engines:
+        results[engine] = await simulate(engine, args)
+    print(f"{'engine':<10} {'matched':>8} {'gave up':>8} {'p50, s':>8} {'p90, s':>8} {'p99, s':>8} "
+          f"{'max, s':>8} {'strict':>7} {'lang':>7} {'repeat':>7}")
+    for engine, r in results.items():
+        w = r['wait_s']
+        print(f"{engine:<10} {r['matched_users']:>8} {r['gave_up']:>8} {w['p50']:>8.2f} {w['p90']:>8.2f} "
+              f"{w['p99']:>8.2f} {w['max']:>8.2f} {r['strict_share']:>7.3f} {r['same_language_share']:>7.3f} "
+              f"{r['repeat_share']:>7.4f}")
+    write_results('match_sim', results, args.json, {
+        key: value for key, value in vars(args).items() if key != 'json'
+    })
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Matchmaking simulator: wait-time percentiles and match quality')
+    parser.add_argument('--engines', nargs='+', default=['criteria', 'random'], choices=['criteria', 'random'])
+    parser.add_argument('--hours', type=float, default=1.0, help='simulated time')
+    parser.add_argument('--arrival-rate', type=float, default=2.0, help='new users per second')
+    parser.add_argument('--chat-seconds', type=float, default=120.0, help='mean chat length')
+    parser.add_argument('--return-prob', type=float, default=0.7, help='chance to search again after a chat')
+    parser.add_argument('--patience', type=float, default=300.0, help='seconds before a waiting user gives up')
+    parser.add_argument('--relax-after', type=float, default=15.0)
+    parser.add_argument('--history', type=int, default=3)
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    loop = VirtualClockLoop()
+    try:
+        loop.run_until_complete(run(parse_args()))
+    finally:
+        loop.close()
@@ -0,0 +1,72 @@
+# Микробенчмарк RandomMatchQueue: add/remove/get_random_pair/drain_pairs при разном размере очереди.
+# Запуск из корня репозитория: python -m benchmarks.queue_bench [--json results.json]
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.common import summarize, time_async, write_results, print_results
+from match_queue import RandomMatchQueue
+
+SIZES = [10, 100, 1_000, 10_000, 100_000]
+
+async def filled_queue(size):
+    queue = RandomMatchQueue()
+    for user_id in range(size):
+        await queue.add(user_id)
+    return queue
+
+async def bench_size(size, rounds):
+    results = {}
+    next_id = size
+
+    # add + remove: размер очереди остаётся постоянным
+    queue = await filled_queue(size)
+    new_ids = list(range(next_id, next_id + rounds))
+    results[f'add/{size}'] = await time_async(queue.add, ((i,) for i in new_ids))
+    results[f'remove/{size}'] = await time_async(queue.remove, ((i,) for i in new_ids))
+
+    # get_random_pair: после каждой пары возвращаем в очередь двух новых (вне замера)
+    queue = await filled_queue(size)
+    samples = []
+    for i in range(rounds):
+        started = time.perf_counter()
+        await queue.get_random_pair()
+        samples.append(time.perf_counter() - started)
+        await queue.add(next_id + 2 * i)
+        await queue.add(next_id + 2 * i + 1)
+    results[f'get_random_pair/{size}'] = summarize(samples)
+
+    # drain_pairs(50): одна блокировка на пакет пар
+    if size >= 100:
+        queue = await filled_queue(size)
+        samples = []
+        base = 10**9
+        for _ in range(max(rounds // 50, 10)):
+            started = time.perf_counter()
+            await queue.drain_pairs(50)
+            samples.append(time.perf_counter() - started)
+            for i in range(100):
+                await queue.add(base + i)
+            base += 100
+        results[f'drain_pairs_50/{size}'] = summarize(samples)
+    return results
+
+async def main(args):
+    random.seed(args.seed)
+    results = {}
+    for size in args.sizes:
+        results.update(await bench_size(size, args.rounds))
+    print_results(results)
+    write_results('queue', results, args.json, {'sizes': args.sizes, 'rounds': args.rounds, 'seed': args.seed})
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='RandomMatchQueue micro-benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--rounds', type=int, default=2_000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -1,199 +1,985 @@
+import asyncio
 import asyncpg
+import heapq
 import os
-from datetime import datetime, timedelta
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
 import logging
 
+from instrumentation import record_query
+from metrics import Counter, Gauge, Histogram
+from migrations import migrate
+
 DATABASE_URL = os.getenv("DATABASE_URL")
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+REPORT_COUNTS_SIZE = int(os.getenv("REPORT_COUNTS_SIZE", "50000"))
+PERMANENT_BAN_SECONDS = 100 * 365 * 24 * 3600
+QUEUE_CHANNEL = 'search_queue'
+INVALIDATE_CHANNEL = 'cache_invalidate'
+NODE_ID = uuid.uuid4().hex[:12]
+WRITE_FLUSH_ROWS = int(os.getenv("WRITE_FLUSH_ROWS", "500"))
+WRITE_BUFFER_LIMIT = int(os.getenv("WRITE_BUFFER_LIMIT", "5000"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "2"))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "30"))
+# Сколько полных прошлых месяцев chat_logs хранится построчно (0 — хранить всё)
+CHAT_LOG_RETENTION_MONTHS = int(os.getenv("CHAT_LOG_RETENTION_MONTHS", "3"))
+CHAT_LOG_MONTHS_AHEAD = 2
+CHAT_LOG_MAINTENANCE_INTERVAL = float(os.getenv("CHAT_LOG_MAINTENANCE_INTERVAL", "3600"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# Сколько секунд ждать свободное соединение, прежде чем запрос завершится ошибкой
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "2"))
+# Пауза между попытками переподключить LISTEN растёт до этого предела
+LISTEN_RETRY_MAX = 30
 pool = None
+listen_conn = None
+cache_sync = False
+
+# === МЕТРИКИ ===
+# Счётчики засеваются одним запросом при старте и дальше ведутся в памяти процесса
+USERS_TOTAL = Gauge('bot_users_total', 'Known users')
+ACTIVE_CHATS = Gauge('bot_active_chats', 'Chats currently in progress')
+REPORTS_TOTAL = Gauge('bot_reports_total', 'Stored reports')
+REPORTS_CREATED = Counter('bot_reports_created_total', 'Reports received since start')
+DB_POOL_SIZE = Gauge('bot_db_pool_size', 'Open connections in the pool',
+                     function=lambda: pool.get_size() if pool else 0)
+DB_POOL_IN_USE = Gauge('bot_db_pool_in_use', 'Connections checked out of the pool',
+                       function=lambda: pool.get_size() - pool.get_idle_size() if pool else 0)
+DB_POOL_WAIT = Histogram('bot_db_pool_acquire_seconds', 'Time spent waiting for a pool connection')
+DB_POOL_SATURATED = Gauge('bot_db_pool_saturated', '1 when every pool connection is checked out',
+                          function=lambda: int(pool_saturated()))
+DB_POOL_TIMEOUTS = Counter('bot_db_pool_timeouts_total', 'Pool acquires that gave up after DB_ACQUIRE_TIMEOUT',
+                           ['query'])
+reports_day = {'day': date.today(), 'count': 0}
+
+# === КЭШ СЕССИЙ ===
+class UserCache:
+    # LRU с ограничением размера и TTL; записи обновляются при каждой записи в users
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, tg_id):
+        entry = self._rows.get(tg_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, row = entry
+        if expires_at < time.monotonic():
+            del self._rows[tg_id]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(tg_id)
+        self.hits += 1
+        return dict(row)
+
+    def put(self, tg_id, row):
+        if self.max_size <= 0:
+            return
+        self._rows[tg_id] = (time.monotonic() + self.ttl, dict(row))
+        self._rows.move_to_end(tg_id)
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, tg_id, **fields):
+        # Обновляем только уже закэшированные строки: частичную строку не выдумываем
+        entry = self._rows.get(tg_id)
+        if entry is not None:
+            entry[1].update(fields)
+
+    def invalidate(self, tg_id):
+        self._rows.pop(tg_id, None)
+
+    def clear(self):
+        self._rows.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._rows),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# === ИНДЕКС БАНОВ ===
+class BanIndex:
+    # Активные баны в памяти; срочные истекают через min-heap по времени окончания
+    def __init__(self):
+        self.loaded = False
+        self._until = {}
+        self._expiry = []
+
+    def ban(self, tg_id, expires_at):
+        self._until[tg_id] = expires_at
+        heapq.heappush(self._expiry, (expires_at, tg_id))
+
+    def unban(self, tg_id):
+        self._until.pop(tg_id, None)
+
+    def replace(self, entries):
+        self._until = dict(entries)
+        self._expiry = [(expires_at, tg_id) for tg_id, expires_at in self._until.items()]
+        heapq.heapify(self._expiry)
+        self.loaded = True
+
+    def _expire(self):
+        now = time.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, tg_id = heapq.heappop(self._expiry)
+            # Запись могла быть перезаписана более поздним баном
+            if self._until.get(tg_id) == expires_at:
+                del self._until[tg_id]
+
+    def __contains__(self, tg_id):
+        self._expire()
+        return tg_id in self._until
+
+    def __len__(self):
+        self._expire()
+        return len(self._until)
+
+ban_index = BanIndex()
+
+# === СЧЁТЧИКИ ЖАЛОБ ===
+class ReportCounts:
+    # Число жалоб на пользователя: загружается из БД при первом обращении и дальше
+    # ведётся в памяти. LRU по размеру — счётчики давно не упоминавшихся пользователей вытесняются
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._counts = OrderedDict()
+
+    def get(self, tg_id):
+        count = self._counts.get(tg_id)
+        if count is not None:
+            self._counts.move_to_end(tg_id)
+        return count
+
+    def put(self, tg_id, count):
+        if self.max_size <= 0:
+            return
+        self._counts[tg_id] = count
+        self._counts.move_to_end(tg_id)
+        while len(self._counts) > self.max_size:
+            self._counts.popitem(last=False)
+
+    def add(self, tg_id):
+        # Незагруженный счётчик не трогаем: при чтении он подтянется из БД вместе с этой жалобой
+        if tg_id in self._counts:
+            self._counts[tg_id] += 1
+
+    def invalidate(self, tg_id):
+        self._counts.pop(tg_id, None)
+
+    def clear(self):
+        self._counts.clear()
+
+report_counts = ReportCounts(REPORT_COUNTS_SIZE)
+
+# === ОТЛОЖЕННАЯ ЗАПИСЬ ===
+class WriteBuffer:
+    # Копит строки chat_logs и reports и пишет их пачкой через COPY:
+    # по достижении flush_rows или раз в interval секунд.
+    # При limit строк в буфере добавление ждёт сброса (backpressure).
+    def __init__(self, flush_rows, limit, interval):
+        self.flush_rows = flush_rows
+        self.limit = limit
+        self.interval = interval
+        self.chat_logs = []
+        self.reports = []
+        self.flushes = 0
+        self.waits = 0
+        self.dropped = 0
+        self._space = asyncio.Condition()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._task = None
+
+    def __len__(self):
+        return len(self.chat_logs) + len(self.reports)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def add_chat_logs(self, rows):
+        await self._reserve(len(rows))
+        self.chat_logs.extend(rows)
+        self._maybe_flush()
+
+    async def add_report(self, row):
+        await self._reserve(1)
+        self.reports.append(row)
+        self._maybe_flush()
+
+    @asynccontextmanager
+    async def settled(self):
+        # Пока контекст открыт, сброс не идёт: каждая строка либо уже закоммичена в БД, либо лежит в буфере.
+        # Иначе сброс, который вынул строки из буфера, но ещё не закоммитил их, не виден ни там, ни там
+        async with self._flush_lock:
+            yield
+
+    def pending_reports(self, to_id):
+        return sum(1 for row in self.reports if row[1] == to_id)
+
+    def discard_reports(self, to_id):
+        kept = [row for row in self.reports if row[1] != to_id]
+        discarded = len(self.reports) - len(kept)
+        self.reports = kept
+        return discarded
+
+    async def _reserve(self, rows):
+        async with self._space:
+            while len(self) + rows > self.limit:
+                self.waits += 1
+                self._kick()
+                await self._space.wait()
+
+    def _maybe_flush(self):
+        if len(self) >= self.flush_rows:
+            self._kick()
+
+    def _kick(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            chat_logs, self.chat_logs = self.chat_logs, []
+            reports, self.reports = self.reports, []
+            if not (chat_logs or reports):
+                return
+            try:
+                async with _acquire('write_buffer_flush') as conn:
+                    async with conn.transaction():
+                        await self._write(conn, chat_logs, reports)
+                self.flushes += 1
+            except Exception as e:
+                logging.error(f"Error flushing write buffer ({len(chat_logs)} chat logs, {len(reports)} reports): {e}")
+                # Возвращаем в начало буфера, лишнее сверх лимита теряем
+                self.chat_logs[:0] = chat_logs
+                self.reports[:0] = reports
+                overflow = len(self) - self.limit
+                if overflow > 0:
+                    self.dropped += overflow
+                    del self.chat_logs[:min(overflow, len(self.chat_logs))]
+                    overflow = len(self) - self.limit
+                    if overflow > 0:
+                        del self.reports[:overflow]
+            finally:
+                async with self._space:
+                    self._space.notify_all()
+
+    async def _write(self, conn, chat_logs, reports):
+        if chat_logs:
+            await conn.copy_records_to_table(
+                'chat_logs', records=chat_logs, columns=['user_id', 'partner_id', 'duration', 'ended_at']
+            )
+            # Статистика обновляется в той же транзакции, что и запись логов
+            totals = {}
+            for user_id, _, duration, ended_at in chat_logs:
+                count, seconds, last = totals.get(user_id, (0, 0.0, ended_at))
+                seconds += duration.total_seconds() if duration else 0.0
+                totals[user_id] = (count + 1, seconds, max(last, ended_at))
+            # Строки блокируются в порядке user_id, как в ActivityTracker: сбросы соседних воркеров
+            # с общими пользователями иначе могут заблокировать друг друга
+            ids = sorted(totals)
+            await conn.execute('''
+                INSERT INTO user_stats (user_id, chat_count, total_seconds, last_chat)
+                SELECT * FROM unnest($1::bigint[], $2::int[], $3::double precision[], $4::timestamp[])
+                ON CONFLICT (user_id) DO UPDATE SET
+                    chat_count = user_stats.chat_count + EXCLUDED.chat_count,
+                    total_seconds = user_stats.total_seconds + EXCLUDED.total_seconds,
+                    last_chat = GREATEST(user_stats.last_chat, EXCLUDED.last_chat)
+            ''', ids, [totals[i][0] for i in ids], [totals[i][1] for i in ids], [totals[i][2] for i in ids])
+        if reports:
+            await conn.copy_records_to_table(
+                'reports', records=reports, columns=['from_id', 'to_id', 'reason', 'timestamp']
+            )
+
+write_buffer = WriteBuffer(WRITE_FLUSH_ROWS, WRITE_BUFFER_LIMIT, WRITE_FLUSH_INTERVAL)
 
 async def init_db():
     global pool
+    started = time.monotonic()
     try:
-        pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
-        async with pool.acquire() as conn:
-            # users
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    tg_id BIGINT PRIMARY KEY,
-                    state TEXT DEFAULT 'menu',
-                    partner_id BIGINT,
-                    chat_start TIMESTAMP,
-                    last_search_msg_id BIGINT,
-                    last_active TIMESTAMP DEFAULT NOW(),
-                    created_at TIMESTAMP DEFAULT NOW()
-                );
-            ''')
+        pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=DB_POOL_MAX)
+        async with _acquire('init_db') as conn:
+            version = await migrate(conn)
 
-            # reports
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS reports (
-                    id SERIAL PRIMARY KEY,
-                    from_id BIGINT,
-                    to_id BIGINT,
-                    reason TEXT,
-                    timestamp TIMESTAMP DEFAULT NOW()
-                );
-            ''')
+        await load_bans()
+        await seed_counters()
+        logging.info(f"Database initialized in {time.monotonic() - started:.3f}s (schema version {version})")
+    except Exception as e:
+        logging.error(f"Database initialization failed: {e}")
+        raise
 
-            # bans
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS bans (
-                    tg_id BIGINT PRIMARY KEY,
-                    until TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT NOW()
-                );
-            ''')
+async def close_db():
+    global listen_conn
+    if _listen_task is not None:
+        _listen_task.cancel()
+    if listen_conn is not None:
+        # Сначала забываем соединение, чтобы его закрытие не запустило переподключение
+        conn, listen_conn = listen_conn, None
+        await conn.close()
+    if pool is not None:
+        await pool.close()
 
-            # chat_logs
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS chat_logs (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    partner_id BIGINT,
-                    duration INTERVAL,
-                    ended_at TIMESTAMP DEFAULT NOW()
-                );
+def pool_saturated():
+    # Все соединения открыты и заняты — новые запросы встанут в очередь на пул
+    return pool is not None and pool.get_idle_size() == 0 and pool.get_size() >= pool.get_max_size()
+
+@asynccontextmanager
+async def _acquire(name):
+    # Соединение из пула с учётом ожидания и времени работы под именем запроса.
+    # Ожидание ограничено DB_ACQUIRE_TIMEOUT: при перегрузке запрос падает быстро, а не висит в очереди
+    started = time.perf_counter()
+    try:
+        conn = await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        DB_POOL_TIMEOUTS.inc(query=name)
+        logging.warning(f"Pool acquire for {name} timed out after {DB_ACQUIRE_TIMEOUT}s")
+        raise
+    acquired = time.perf_counter()
+    DB_POOL_WAIT.observe(acquired - started)
+    try:
+        yield conn
+    finally:
+        record_query(name, acquired - started, time.perf_counter() - started)
+        await pool.release(conn)
+
+async def seed_counters():
+    try:
+        async with _acquire('seed_counters') as conn:
+            row = await conn.fetchrow('''
+                SELECT
+                    (SELECT COUNT(*) FROM users) AS users,
+                    (SELECT COUNT(*) FROM users WHERE state = 'chat') AS in_chat,
+                    (SELECT COUNT(*) FROM reports) AS reports,
+                    (SELECT COUNT(*) FROM reports WHERE timestamp >= CURRENT_DATE) AS reports_today
             ''')
+        USERS_TOTAL.set(row['users'])
+        ACTIVE_CHATS.set(row['in_chat'] // 2)
+        REPORTS_TOTAL.set(row['reports'])
+        reports_day.update(day=date.today(), count=row['reports_today'])
+    except Exception as e:
+        logging.error(f"Error seeding counters: {e}")
+
+# === АКТИВНОСТЬ ===
+class ActivityTracker:
+    # last_active копится в памяти (последнее значение на пользователя) и пишется одним
+    # UPDATE раз в interval секунд, а не перезаписью строки users на каждое действие
+    def __init__(self, interval):
+        self.interval = interval
+        self.flushes = 0
+        self._dirty = {}
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def __len__(self):
+        return len(self._dirty)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def touch(self, tg_id, at=None):
+        at = at or datetime.now()
+        self._dirty[tg_id] = at
+        user_cache.update(tg_id, last_active=at)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return 0
+            ids = sorted(dirty)
+            try:
+                async with _acquire('activity_flush') as conn:
+                    # Строки блокируются в порядке tg_id, как в pair_users и _close_chat, — без взаимоблокировок
+                    await conn.execute('''
+                        WITH activity AS (
+                            SELECT * FROM unnest($1::bigint[], $2::timestamp[]) AS a(tg_id, last_active)
+                        ),
+                        locked AS (
+                            SELECT u.tg_id FROM users u JOIN activity USING (tg_id)
+                            ORDER BY u.tg_id
+                            FOR UPDATE
+                        )
+                        UPDATE users u SET last_active = activity.last_active
+                        FROM activity
+                        WHERE u.tg_id = activity.tg_id AND u.tg_id IN (SELECT tg_id FROM locked)
+                    ''', ids, [dirty[tg_id] for tg_id in ids])
+                self.flushes += 1
+                return len(ids)
+            except Exception as e:
+                logging.error(f"Error flushing activity for {len(ids)} users: {e}")
+                # Более свежие отметки, пришедшие во время сброса, важнее возвращаемых
+                for tg_id, at in dirty.items():
+                    self._dirty.setdefault(tg_id, at)
+                return 0
+
+activity = ActivityTracker(ACTIVITY_FLUSH_INTERVAL)
+
+# === СИНХРОНИЗАЦИЯ МЕЖДУ ПРОЦЕССАМИ ===
+# Подписки запоминаются, чтобы восстановить их после обрыва соединения
+_listeners = {}
+_listen_task = None
 
-            # МИГРАЦИИ
-            await conn.execute('ALTER TABLE reports ADD COLUMN IF NOT EXISTS reason TEXT;')
-            await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS chat_start TIMESTAMP;')
-            await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS last_search_msg_id BIGINT;')
+async def listen(channel, callback):
+    # LISTEN держим на отдельном соединении вне пула
+    _listeners.setdefault(channel, []).append(callback)
+    if listen_conn is not None:
+        await listen_conn.add_listener(channel, callback)
+    elif _listen_task is None:
+        await _connect_listener()
 
-        logging.info("Database initialized successfully")
+async def _connect_listener():
+    global listen_conn
+    conn = await asyncpg.connect(DATABASE_URL)
+    for channel, callbacks in _listeners.items():
+        for callback in callbacks:
+            await conn.add_listener(channel, callback)
+    conn.add_termination_listener(_on_listen_lost)
+    listen_conn = conn
+
+def _on_listen_lost(conn):
+    global listen_conn, _listen_task
+    if conn is not listen_conn:
+        return
+    listen_conn = None
+    logging.warning("LISTEN connection lost, reconnecting")
+    _drop_synced_caches()
+    _listen_task = asyncio.ensure_future(_reconnect_listener())
+
+async def _reconnect_listener():
+    global _listen_task
+    delay = 1
+    while True:
+        try:
+            await _connect_listener()
+            break
+        except Exception as e:
+            logging.error(f"LISTEN reconnect failed, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LISTEN_RETRY_MAX)
+    _listen_task = None
+    logging.info("LISTEN connection restored")
+    # Уведомления соседей за время обрыва потеряны: всё, что по ним синхронизируется, перечитываем
+    _drop_synced_caches()
+    if cache_sync:
+        await load_bans()
+
+def _drop_synced_caches():
+    if cache_sync:
+        user_cache.clear()
+        report_counts.clear()
+
+async def enable_cache_sync():
+    # Несколько процессов: кэш сессий и индекс банов сбрасываются по NOTIFY от соседей
+    global cache_sync
+    await listen(INVALIDATE_CHANNEL, _on_invalidate)
+    cache_sync = True
+
+async def _publish_invalidation(conn, kind, ids):
+    if cache_sync:
+        payload = f"{NODE_ID}|{kind}|{','.join(str(i) for i in ids)}"
+        await conn.execute('SELECT pg_notify($1, $2)', INVALIDATE_CHANNEL, payload)
+
+def _on_invalidate(conn, pid, channel, payload):
+    node, kind, ids = payload.split('|')
+    if node == NODE_ID:
+        return
+    for tg_id in map(int, ids.split(',')):
+        if kind == 'user':
+            user_cache.invalidate(tg_id)
+        elif kind == 'ban':
+            # Разбан удаляет жалобы — счётчик перечитаем из БД
+            report_counts.invalidate(tg_id)
+            asyncio.ensure_future(_reload_ban(tg_id))
+        elif kind == 'report':
+            report_counts.add(tg_id)
+
+async def _reload_ban(tg_id):
+    try:
+        async with _acquire('reload_ban') as conn:
+            remaining = await conn.fetchval(
+                'SELECT EXTRACT(EPOCH FROM until - NOW()) FROM bans WHERE tg_id = $1 AND until > NOW()', tg_id
+            )
+        if remaining is None:
+            ban_index.unban(tg_id)
+        else:
+            ban_index.ban(tg_id, time.time() + float(remaining))
     except Exception as e:
-        logging.error(f"Database initialization failed: {e}")
-        raise
+        logging.error(f"Error reloading ban for {tg_id}: {e}")
 
 # === ПОЛЬЗОВАТЕЛИ ===
+# get_user и закрытие чата возвращают это значение, когда запрос не выполнился (таймаут пула, ошибка БД).
+# В отличие от None это не «пользователя нет» / «не в чате»: состояние неизвестно, писать по нему нельзя
+LOOKUP_FAILED = object()
+
 async def get_user(tg_id):
+    cached = user_cache.get(tg_id)
+    if cached is not None:
+        return cached
     try:
-        async with pool.acquire() as conn:
+        async with _acquire('get_user') as conn:
             row = await conn.fetchrow('SELECT * FROM users WHERE tg_id = $1', tg_id)
-            return dict(row) if row else None
+            if row is None:
+                return None
+            user_cache.put(tg_id, row)
+            return dict(row)
     except Exception as e:
         logging.error(f"Error getting user {tg_id}: {e}")
-        return None
+        return LOOKUP_FAILED
 
 async def update_user(tg_id, **kwargs):
+    # Пишем только колонки, которые отличаются от закэшированной строки; без изменений — ни одного запроса
+    cached = user_cache.get(tg_id)
+    if cached is not None:
+        kwargs = {col: value for col, value in kwargs.items() if cached.get(col) != value}
     if not kwargs:
         return
     try:
-        async with pool.acquire() as conn:
+        async with _acquire('update_user') as conn:
             columns = list(kwargs.keys())
             values = list(kwargs.values())
             set_clause = ', '.join([f"{col} = ${i+2}" for i, col in enumerate(columns)])
             query = f'''
                 INSERT INTO users (tg_id, {', '.join(columns)})
                 VALUES ($1, {', '.join([f'${i+2}' for i in range(len(values))])})
-                ON CONFLICT (tg_id) DO UPDATE SET {set_clause}, last_active = NOW()
+                ON CONFLICT (tg_id) DO UPDATE SET {set_clause}
+                RETURNING *, (xmax = 0) AS inserted
             '''
-            await conn.execute(query, tg_id, *values)
+            row = dict(await conn.fetchrow(query, tg_id, *values))
+            if row.pop('inserted'):
+                USERS_TOTAL.inc()
+            user_cache.put(tg_id, row)
+            await _publish_invalidation(conn, 'user', [tg_id])
     except Exception as e:
+        user_cache.invalidate(tg_id)
         logging.error(f"Error updating user {tg_id}: {e}")
 
+async def pair_users(user1, user2, chat_start=None):
+    # Атомарно переводит обоих из 'searching' в 'chat': либо оба, либо никто
+    if chat_start is None:
+        chat_start = datetime.now()
+    try:
+        async with _acquire('pair_users') as conn:
+            result = await conn.execute('''
+                WITH locked AS (
+                    SELECT tg_id FROM users
+                    WHERE tg_id IN ($1, $2) AND state = 'searching'
+                    ORDER BY tg_id
+                    FOR UPDATE
+                )
+                UPDATE users u
+                SET state = 'chat',
+                    partner_id = CASE WHEN u.tg_id = $1 THEN $2 ELSE $1 END,
+                    chat_start = $3
+                WHERE u.tg_id IN (SELECT tg_id FROM locked)
+                  AND (SELECT COUNT(*) FROM locked) = 2
+            ''', user1, user2, chat_start)
+            if result != 'UPDATE 2':
+                return False
+            ACTIVE_CHATS.inc()
+            await _publish_invalidation(conn, 'user', [user1, user2])
+            user_cache.update(user1, state='chat', partner_id=user2, chat_start=chat_start)
+            user_cache.update(user2, state='chat', partner_id=user1, chat_start=chat_start)
+            return True
+    except Exception as e:
+        user_cache.invalidate(user1)
+        user_cache.invalidate(user2)
+        logging.error(f"Error pairing users {user1} and {user2}: {e}")
+        raise
+
+async def cancel_searching(tg_id):
+    # Отмена поиска — только из 'searching': если pair_users успел соединить пару, состояние не трогаем.
+    # True — поиск отменён, False — пользователь уже не ищет, LOOKUP_FAILED — ошибка БД
+    try:
+        async with _acquire('cancel_searching') as conn:
+            result = await conn.execute(
+                "UPDATE users SET state = 'menu' WHERE tg_id = $1 AND state = 'searching'", tg_id
+            )
+            if result != 'UPDATE 1':
+                user_cache.invalidate(tg_id)
+                return False
+            user_cache.update(tg_id, state='menu')
+            await _publish_invalidation(conn, 'user', [tg_id])
+            return True
+    except Exception as e:
+        user_cache.invalidate(tg_id)
+        logging.error(f"Error cancelling search for {tg_id}: {e}")
+        return LOOKUP_FAILED
+
+async def reset_stale_searching(max_age_minutes):
+    # Кто «ищет» дольше max_age_minutes без активности — возвращаем в меню
+    try:
+        async with _acquire('reset_stale_searching') as conn:
+            # Вместе со сменой состояния убираем их из общей очереди и сбрасываем кэш у соседних воркеров:
+            # при поэтапном деплое старые процессы ещё работают и иначе считали бы их ищущими
+            rows = await conn.fetch('''
+                WITH reset AS (
+                    UPDATE users SET state = 'menu'
+                    WHERE state = 'searching' AND last_active < NOW() - INTERVAL '1 minute' * $1
+                    RETURNING tg_id
+                ),
+                dequeued AS (
+                    DELETE FROM search_queue WHERE tg_id IN (SELECT tg_id FROM reset)
+                )
+                SELECT tg_id FROM reset
+            ''', max_age_minutes)
+            ids = [row['tg_id'] for row in rows]
+            for tg_id in ids:
+                user_cache.update(tg_id, state='menu')
+            if ids:
+                await _publish_invalidation(conn, 'user', ids)
+            return len(ids)
+    except Exception as e:
+        logging.error(f"Error resetting stale searching users: {e}")
+        return 0
+
+async def iter_searching_users(batch_size=1000):
+    # Курсор, чтобы не тянуть в память всю выборку на больших таблицах
+    async with _acquire('iter_searching_users') as conn:
+        async with conn.transaction():
+            async for row in conn.cursor(
+                "SELECT tg_id, language, age_group FROM users WHERE state = 'searching'", prefetch=batch_size
+            ):
+                yield dict(row)
+
+# === ОЧЕРЕДЬ ПОИСКА (PostgreSQL) ===
+async def queue_add(tg_id):
+    # Вставка и NOTIFY одним запросом; уведомление уходит только если пользователь новый
+    try:
+        async with _acquire('queue_add') as conn:
+            row = await conn.fetchrow('''
+                WITH ins AS (
+                    INSERT INTO search_queue (tg_id) VALUES ($1)
+                    ON CONFLICT (tg_id) DO NOTHING
+                    RETURNING tg_id
+                )
+                SELECT tg_id, pg_notify($2, '') FROM ins
+            ''', tg_id, QUEUE_CHANNEL)
+            return row is not None
+    except Exception as e:
+        logging.error(f"Error adding {tg_id} to search queue: {e}")
+        return False
+
+async def queue_remove(tg_id):
+    try:
+        async with _acquire('queue_remove') as conn:
+            result = await conn.execute('DELETE FROM search_queue WHERE tg_id = $1', tg_id)
+            return result != 'DELETE 0'
+    except Exception as e:
+        logging.error(f"Error removing {tg_id} from search queue: {e}")
+        return False
+
+async def queue_claim(limit):
+    # Забираем до limit самых давних; строки, занятые другим процессом, пропускаем.
+    # Возвращает [(tg_id, секунд в очереди)]
+    try:
+        async with _acquire('queue_claim') as conn:
+            async with conn.transaction():
+                rows = await conn.fetch('''
+                    SELECT tg_id, EXTRACT(EPOCH FROM NOW() - enqueued_at) AS waited
+                    FROM search_queue
+                    ORDER BY enqueued_at
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                ''', limit)
+                claimed = [(row['tg_id'], float(row['waited'])) for row in rows]
+                claimed = claimed[:len(claimed) - len(claimed) % 2]
+                if claimed:
+                    await conn.execute(
+                        'DELETE FROM search_queue WHERE tg_id = ANY($1::bigint[])', [c[0] for c in claimed]
+                    )
+                return claimed
+    except Exception as e:
+        logging.error(f"Error claiming from search queue: {e}")
+        return []
+
+async def queue_size():
+    try:
+        async with _acquire('queue_size') as conn:
+            return await conn.fetchval('SELECT COUNT(*) FROM search_queue')
+    except Exception as e:
+        logging.error(f"Error getting search queue size: {e}")
+        return 0
+
 # === ЧАТЫ ===
 async def log_chat_end(user_id, partner_id, duration):
     try:
-        async with pool.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO chat_logs (user_id, partner_id, duration) VALUES ($1, $2, $3)',
-                user_id, partner_id, duration
-            )
-            await conn.execute(
-                'INSERT INTO chat_logs (user_id, partner_id, duration) VALUES ($1, $2, $3)',
-                partner_id, user_id, duration
-            )
+        ended_at = datetime.now()
+        await write_buffer.add_chat_logs([
+            (user_id, partner_id, duration, ended_at),
+            (partner_id, user_id, duration, ended_at),
+        ])
     except Exception as e:
         logging.error(f"Error logging chat: {e}")
 
 async def get_user_chat_stats(tg_id):
     try:
-        async with pool.acquire() as conn:
-            total_chats = await conn.fetchval(
-                'SELECT COUNT(*) FROM chat_logs WHERE user_id = $1', tg_id
-            )
-            total_seconds = await conn.fetchval(
-                'SELECT COALESCE(SUM(EXTRACT(EPOCH FROM duration)), 0) FROM chat_logs WHERE user_id = $1', tg_id
+        async with _acquire('get_user_chat_stats') as conn:
+            row = await conn.fetchrow(
+                'SELECT chat_count, total_seconds FROM user_stats WHERE user_id = $1', tg_id
             )
-            return total_chats or 0, int(total_seconds)
+            if row is None:
+                return 0, 0
+            return row['chat_count'], int(row['total_seconds'])
     except Exception as e:
         logging.error(f"Error getting chat stats: {e}")
         return 0, 0
 
+async def _close_chat(tg_id, from_states, new_state, name):
+    # Один запрос: блокируем обе строки в порядке tg_id, проверяем, что собеседник
+    # всё ещё ссылается на нас, и разводим пару. Встречные клики «Следующий» с двух
+    # сторон сериализуются на блокировке: второй увидит, что чат уже закрыт.
+    try:
+        async with _acquire(name) as conn:
+            row = await conn.fetchrow('''
+                WITH locked AS (
+                    SELECT tg_id, state, partner_id, chat_start FROM users
+                    WHERE tg_id = $1 OR tg_id = (SELECT partner_id FROM users WHERE tg_id = $1)
+                    ORDER BY tg_id
+                    FOR UPDATE
+                ),
+                me AS (
+                    SELECT * FROM locked WHERE tg_id = $1 AND state = ANY($2::text[])
+                ),
+                partner AS (
+                    SELECT l.tg_id FROM locked l
+                    JOIN me ON l.tg_id = me.partner_id
+                    WHERE l.partner_id = me.tg_id
+                ),
+                upd AS (
+                    UPDATE users u
+                    SET state = CASE WHEN u.tg_id = $1 THEN $3 ELSE 'menu' END,
+                        partner_id = NULL,
+                        chat_start = NULL
+                    WHERE u.tg_id IN (SELECT tg_id FROM me UNION ALL SELECT tg_id FROM partner)
+                    RETURNING u.tg_id
+                )
+                SELECT me.partner_id, me.chat_start,
+                       EXISTS (SELECT 1 FROM partner) AS partner_linked,
+                       (SELECT COUNT(*) FROM upd) AS updated
+                FROM me
+            ''', tg_id, list(from_states), new_state)
+            if row is None:
+                return None
+            result = dict(row)
+            partner_id = result['partner_id']
+            user_cache.update(tg_id, state=new_state, partner_id=None, chat_start=None)
+            changed = [tg_id]
+            if result['partner_linked']:
+                user_cache.update(partner_id, state='menu', partner_id=None, chat_start=None)
+                changed.append(partner_id)
+                ACTIVE_CHATS.dec()
+            await _publish_invalidation(conn, 'user', changed)
+            return result
+    except Exception as e:
+        user_cache.invalidate(tg_id)
+        logging.error(f"Error closing chat for {tg_id}: {e}")
+        return LOOKUP_FAILED
+
+async def _log_closed_chat(tg_id, result):
+    # Лог пишет только та сторона, что действительно закрыла пару — без дублей
+    if result['partner_linked'] and result['chat_start']:
+        duration = datetime.now() - result['chat_start']
+        await log_chat_end(tg_id, result['partner_id'], duration)
+
+async def end_chat(tg_id):
+    # «⏹️ Завершить»: оба в меню. None — пользователь не в чате, LOOKUP_FAILED — ошибка БД
+    result = await _close_chat(tg_id, ['chat'], 'menu', 'end_chat')
+    if result is not None and result is not LOOKUP_FAILED:
+        await _log_closed_chat(tg_id, result)
+    return result
+
+async def next_chat(tg_id):
+    # «➡️ Следующий»: собеседник в меню, сам пользователь — в поиск
+    result = await _close_chat(tg_id, ['chat'], 'searching', 'next_chat')
+    if result is not None and result is not LOOKUP_FAILED:
+        await _log_closed_chat(tg_id, result)
+    return result
+
+async def close_chat_with_report(tg_id, reason):
+    # Жалоба: закрываем чат и записываем жалобу на собеседника
+    result = await _close_chat(tg_id, ['reporting'], 'menu', 'close_chat_with_report')
+    if result is None or result is LOOKUP_FAILED:
+        return result
+    await _log_closed_chat(tg_id, result)
+    if result['partner_id']:
+        await add_report(tg_id, result['partner_id'], reason)
+    return result
+
 # === ОТЧЁТЫ ===
 async def add_report(reporter_id, reported_id, reason=None):
     try:
-        async with pool.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO reports (from_id, to_id, reason) VALUES ($1, $2, $3)',
-                reporter_id, reported_id, reason
-            )
+        await write_buffer.add_report((reporter_id, reported_id, reason, datetime.now()))
+        report_counts.add(reported_id)
+        REPORTS_TOTAL.inc()
+        REPORTS_CREATED.inc()
+        if reports_day['day'] != date.today():
+            reports_day.update(day=date.today(), count=0)
+        reports_day['count'] += 1
+        if cache_sync:
+            # Жалоба ещё в буфере этого процесса — соседям сообщаем о ней сразу
+            async with _acquire('publish_report') as conn:
+                await _publish_invalidation(conn, 'report', [reported_id])
     except Exception as e:
         logging.error(f"Error adding report: {e}")
 
 async def get_reports_count(tg_id):
+    count = report_counts.get(tg_id)
+    if count is not None:
+        return count
     try:
-        async with pool.acquire() as conn:
-            return await conn.fetchval('SELECT COUNT(*) FROM reports WHERE to_id = $1', tg_id)
+        async with write_buffer.settled():
+            async with _acquire('get_reports_count') as conn:
+                count = await conn.fetchval('SELECT COUNT(*) FROM reports WHERE to_id = $1', tg_id)
+            count += write_buffer.pending_reports(tg_id)
+        report_counts.put(tg_id, count)
+        return count
     except Exception as e:
         logging.error(f"Error getting reports count: {e}")
         return 0
 
-async def get_all_reports():
+async def get_reports_page(to_id=None, cursor=None, newer=False, limit=10):
+    # Keyset-пагинация по (timestamp, id): без OFFSET и без пересортировки всей таблицы.
+    # cursor — (timestamp, id) крайней строки предыдущей страницы, newer — листаем к новым.
+    # Возвращает строки от новых к старым и признак того, что в этом направлении есть ещё
+    conditions, args = [], []
+    if to_id is not None:
+        args.append(to_id)
+        conditions.append(f'to_id = ${len(args)}')
+    if cursor is not None:
+        args.extend(cursor)
+        conditions.append(f"(timestamp, id) {'>' if newer else '<'} (${len(args) - 1}, ${len(args)})")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'ASC' if newer else 'DESC'
+    args.append(limit + 1)
     try:
-        async with pool.acquire() as conn:
-            rows = await conn.fetch('SELECT * FROM reports ORDER BY timestamp DESC LIMIT 50')
-            return [dict(row) for row in rows]
+        async with _acquire('get_reports_page') as conn:
+            rows = await conn.fetch(f'''
+                SELECT id, from_id, to_id, reason, timestamp FROM reports {where}
+                ORDER BY timestamp {order}, id {order}
+                LIMIT ${len(args)}
+            ''', *args)
+        rows = [dict(row) for row in rows]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if newer:
+            rows.reverse()
+        return rows, has_more
     except Exception as e:
-        logging.error(f"Error getting all reports: {e}")
-        return []
+        logging.error(f"Error getting reports page: {e}")
+        return [], False
 
-async def get_user_reports(tg_id):
+async def get_user_dossier(tg_id, limit=5):
+    # Всё для /user одним запросом: число жалоб, активный бан и последние жалобы
     try:
-        async with pool.acquire() as conn:
-            rows = await conn.fetch('SELECT * FROM reports WHERE to_id = $1 ORDER BY timestamp DESC LIMIT 10', tg_id)
-            return [dict(row) for row in rows]
+        async with _acquire('get_user_dossier') as conn:
+            rows = await conn.fetch('''
+                SELECT c.reports_count, b.until AS banned_until, r.from_id, r.reason, r.timestamp
+                FROM (SELECT COUNT(*) AS reports_count FROM reports WHERE to_id = $1) c
+                LEFT JOIN bans b ON b.tg_id = $1 AND b.until > NOW()
+                LEFT JOIN LATERAL (
+                    SELECT from_id, reason, timestamp, id FROM reports
+                    WHERE to_id = $1
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT $2
+                ) r ON TRUE
+                ORDER BY r.timestamp DESC, r.id DESC
+            ''', tg_id, limit)
+        count = rows[0]['reports_count'] + write_buffer.pending_reports(tg_id)
+        report_counts.put(tg_id, count)
+        return {
+            'reports_count': count,
+            'banned_until': rows[0]['banned_until'],
+            'reports': [dict(row) for row in rows if row['timestamp'] is not None],
+        }
     except Exception as e:
-        logging.error(f"Error getting user reports: {e}")
-        return []
+        logging.error(f"Error getting dossier for {tg_id}: {e}")
+        return None
 
 async def get_reports_today():
-    try:
-        async with pool.acquire() as conn:
-            return await conn.fetchval('SELECT COUNT(*) FROM reports WHERE timestamp >= CURRENT_DATE')
-    except Exception as e:
-        logging.error(f"Error getting today's reports: {e}")
+    if reports_day['day'] != date.today():
         return 0
+    return reports_day['count']
 
 # === БАНЫ ===
 async def ban_user(tg_id, hours=24):
     try:
-        async with pool.acquire() as conn:
+        async with _acquire('ban_user') as conn:
             await conn.execute('''
                 INSERT INTO bans (tg_id, until)
                 VALUES ($1, NOW() + INTERVAL '1 hour' * $2)
                 ON CONFLICT (tg_id) DO UPDATE SET until = EXCLUDED.until
             ''', tg_id, hours)
+            ban_index.ban(tg_id, time.time() + hours * 3600)
             await conn.execute('UPDATE users SET state = $1, partner_id = NULL WHERE tg_id = $2', 'menu', tg_id)
+            user_cache.update(tg_id, state='menu', partner_id=None)
+            await _publish_invalidation(conn, 'user', [tg_id])
+            await _publish_invalidation(conn, 'ban', [tg_id])
     except Exception as e:
+        user_cache.invalidate(tg_id)
         logging.error(f"Error banning user {tg_id}: {e}")
 
 async def ban_user_permanent(tg_id):
     try:
-        async with pool.acquire() as conn:
+        async with _acquire('ban_user_permanent') as conn:
             await conn.execute('''
                 INSERT INTO bans (tg_id, until)
                 VALUES ($1, NOW() + INTERVAL '100 years')
                 ON CONFLICT (tg_id) DO UPDATE SET until = EXCLUDED.until
             ''', tg_id)
+            ban_index.ban(tg_id, time.time() + PERMANENT_BAN_SECONDS)
             await conn.execute('UPDATE users SET state = $1, partner_id = NULL WHERE tg_id = $2', 'menu', tg_id)
+            user_cache.update(tg_id, state='menu', partner_id=None)
+            await _publish_invalidation(conn, 'user', [tg_id])
+            await _publish_invalidation(conn, 'ban', [tg_id])
     except Exception as e:
+        user_cache.invalidate(tg_id)
         logging.error(f"Error permanent banning user {tg_id}: {e}")
 
 async def is_banned(tg_id):
+    if ban_index.loaded:
+        return tg_id in ban_index
     try:
-        async with pool.acquire() as conn:
+        async with _acquire('is_banned') as conn:
             row = await conn.fetchrow('SELECT until FROM bans WHERE tg_id = $1 AND until > NOW()', tg_id)
             return row is not None
     except Exception as e:
@@ -202,20 +988,101 @@ async def is_banned(tg_id):
 
 async def unban_user(tg_id):
     try:
-        async with pool.acquire() as conn:
+        async with _acquire('unban_user') as conn:
             await conn.execute('DELETE FROM bans WHERE tg_id = $1', tg_id)
-            await conn.execute('DELETE FROM reports WHERE to_id = $1', tg_id)
+            ban_index.unban(tg_id)
+            discarded = write_buffer.discard_reports(tg_id)
+            result = await conn.execute('DELETE FROM reports WHERE to_id = $1', tg_id)
+            report_counts.invalidate(tg_id)
+            await _publish_invalidation(conn, 'ban', [tg_id])
+            REPORTS_TOTAL.dec(discarded + int(result.split()[-1]))
     except Exception as e:
         logging.error(f"Error unbanning user {tg_id}: {e}")
 
+async def load_bans():
+    # Полная пересборка индекса из таблицы bans (при старте и по команде модератора)
+    try:
+        async with _acquire('load_bans') as conn:
+            rows = await conn.fetch(
+                'SELECT tg_id, EXTRACT(EPOCH FROM until - NOW()) AS remaining FROM bans WHERE until > NOW()'
+            )
+        now = time.time()
+        ban_index.replace((row['tg_id'], now + float(row['remaining'])) for row in rows)
+        logging.info(f"Ban index loaded: {len(rows)} active bans")
+        return len(rows)
+    except Exception as e:
+        logging.error(f"Error loading bans: {e}")
+        return None
+
 # === СТАТИСТИКА ===
 async def get_stats():
+    # Без сканирования таблиц: значения из счётчиков процесса
+    return int(USERS_TOTAL.value()), max(int(ACTIVE_CHATS.value()), 0), int(REPORTS_TOTAL.value())
+
+# === ХРАНЕНИЕ ЛОГОВ ЧАТОВ ===
+# chat_logs секционирована по месяцам. Фоновая задача создаёт секции наперёд, а секции старше
+# CHAT_LOG_RETENTION_MONTHS сворачивает в chat_logs_daily и удаляет.
+# Итоги по пользователям живут в user_stats и от удаления логов не зависят.
+async def maintain_chat_logs(retention_months=CHAT_LOG_RETENTION_MONTHS, months_ahead=CHAT_LOG_MONTHS_AHEAD):
     try:
-        async with pool.acquire() as conn:
-            total_users = await conn.fetchval('SELECT COUNT(*) FROM users')
-            active_chats = await conn.fetchval("SELECT COUNT(*) FROM users WHERE state = 'chat'")
-            total_reports = await conn.fetchval('SELECT COUNT(*) FROM reports')
-            return total_users, active_chats // 2, total_reports
+        async with _acquire('maintain_chat_logs') as conn:
+            # С несколькими воркерами обслуживанием занимается один
+            if not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext('chat_logs_maintenance'))"):
+                return 0
+            try:
+                await conn.execute('''
+                    SELECT create_chat_logs_partition((date_trunc('month', NOW()) + m * INTERVAL '1 month')::date)
+                    FROM generate_series(0, $1::int) AS m
+                ''', months_ahead)
+                # Строки, попавшие в секцию по умолчанию, пока обслуживание стояло, — в секции их месяцев
+                await conn.execute('''
+                    SELECT create_chat_logs_partition(month)
+                    FROM (SELECT DISTINCT date_trunc('month', ended_at)::date AS month FROM chat_logs_default) AS missing
+                ''')
+                if retention_months <= 0:
+                    return 0
+                cutoff = await conn.fetchval(
+                    "SELECT (date_trunc('month', NOW()) - $1::int * INTERVAL '1 month')::date", retention_months
+                )
+                partitions = await conn.fetch('''
+                    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = 'chat_logs'::regclass
+                    ORDER BY c.relname
+                ''')
+                dropped = 0
+                for row in partitions:
+                    name = row['relname']
+                    suffix = name.rsplit('_', 1)[-1]
+                    if not suffix.isdigit():
+                        continue
+                    month = datetime.strptime(suffix, '%Y%m').date()
+                    if month >= cutoff:
+                        continue
+                    async with conn.transaction():
+                        await conn.execute(f'''
+                            INSERT INTO chat_logs_daily (day, chat_count, user_count, total_seconds)
+                            SELECT ended_at::date,
+                                   -- На чат две строки, по одной на участника: чат и его длительность считаем по одной
+                                   COUNT(*) FILTER (WHERE user_id < partner_id), COUNT(DISTINCT user_id),
+                                   COALESCE(SUM(EXTRACT(EPOCH FROM duration)) FILTER (WHERE user_id < partner_id), 0)
+                            FROM "{name}"
+                            GROUP BY ended_at::date
+                            ON CONFLICT (day) DO UPDATE SET
+                                chat_count = chat_logs_daily.chat_count + EXCLUDED.chat_count,
+                                user_count = chat_logs_daily.user_count + EXCLUDED.user_count,
+                                total_seconds = chat_logs_daily.total_seconds + EXCLUDED.total_seconds
+                        ''')
+                        await conn.execute(f'DROP TABLE "{name}"')
+                    dropped += 1
+                    logging.info(f"Rolled up and dropped chat_logs partition {name}")
+                return dropped
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock(hashtext('chat_logs_maintenance'))")
     except Exception as e:
-        logging.error(f"Error getting stats: {e}")
-        return 0, 0, 0
+        logging.error(f"Error maintaining chat_logs partitions: {e}")
+        return 0
+
+async def chat_log_maintenance_loop(interval=CHAT_LOG_MAINTENANCE_INTERVAL):
+    while True:
+        await maintain_chat_logs()
+        await asyncio.sleep(interval)
@@ -0,0 +1,156 @@
+import collections
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+
+from metrics import Histogram
+
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "500"))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+UPDATE_LATENCY = Histogram('bot_update_seconds', 'End-to-end update processing time', ['handler'])
+HANDLER_LATENCY = Histogram('bot_handler_seconds', 'Handler execution time', ['handler'])
+DB_QUERY_LATENCY = Histogram('bot_db_query_seconds', 'Database query time including pool wait', ['query'])
+API_LATENCY = Histogram('bot_api_seconds', 'Bot API call time', ['method'])
+
+# Разбивка времени текущего апдейта: хендлер, запросы к БД, вызовы Bot API
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class Trace:
+    __slots__ = ('handler', 'spans')
+
+    def __init__(self):
+        self.handler = 'unhandled'
+        self.spans = []
+
+    def add(self, kind, name, seconds):
+        self.spans.append((kind, name, seconds))
+
+    def breakdown(self):
+        totals = collections.defaultdict(float)
+        for kind, name, seconds in self.spans:
+            totals[f"{kind}:{name}"] += seconds
+        return ', '.join(f"{key}={value * 1000:.1f}ms" for key, value in sorted(totals.items(), key=lambda kv: -kv[1]))
+
+def record_span(kind, name, seconds):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(kind, name, seconds)
+
+def record_query(name, wait, seconds):
+    DB_QUERY_LATENCY.observe(seconds, query=name)
+    record_span('db', name, seconds)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        logging.warning(f"Slow query {name}: {seconds * 1000:.1f}ms (pool wait {wait * 1000:.1f}ms)")
+
+# --- Middleware ---
+async def update_timing(handler, event, data):
+    # Внешний middleware на dp.update: время апдейта целиком
+    trace = Trace()
+    token = current_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        elapsed = time.perf_counter() - started
+        current_trace.reset(token)
+        UPDATE_LATENCY.observe(elapsed, handler=trace.handler)
+        if elapsed * 1000 >= SLOW_UPDATE_MS:
+            logging.warning(
+                f"Slow update {event.update_id} in {trace.handler}: {elapsed * 1000:.1f}ms "
+                f"[{trace.breakdown() or 'no db/api calls'}]"
+            )
+
+async def handler_timing(handler, event, data):
+    # Внутренний middleware: имя выбранного хендлера и время его работы
+    name = data['handler'].callback.__name__
+    trace = current_trace.get()
+    if trace is not None:
+        trace.handler = name
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        elapsed = time.perf_counter() - started
+        HANDLER_LATENCY.observe(elapsed, handler=name)
+        record_span('handler', name, elapsed)
+
+async def api_timing(make_request, bot, method):
+    # Middleware сессии бота: время каждого вызова Bot API
+    name = type(method).__name__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    finally:
+        elapsed = time.perf_counter() - started
+        API_LATENCY.observe(elapsed, method=name)
+        record_span('api', name, elapsed)
+
+# --- Семплирующий профайлер ---
+class SamplingProfiler:
+    # Фоновый поток раз в interval снимает стек главного потока (где крутится event loop)
+    def __init__(self, interval=PROFILE_INTERVAL, depth=12):
+        self.interval = interval
+        self.depth = depth
+        self.samples = collections.Counter()
+        self.total = 0
+        self._thread = None
+        self._stop = threading.Event()
+        # samples пишет поток профайлера, а report читает event loop: оба — под этой блокировкой
+        self._lock = threading.Lock()
+        self._target = threading.main_thread().ident
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return False
+        with self._lock:
+            self.samples.clear()
+            self.total = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            with self._lock:
+                self.samples[tuple(stack)] += 1
+                self.total += 1
+
+    def report(self, limit=10):
+        # Доля сэмплов по функциям (самый верхний кадр стека)
+        with self._lock:
+            samples = list(self.samples.items())
+            total = self.total
+        own = collections.Counter()
+        for stack, count in samples:
+            if stack:
+                own[stack[0]] += count
+        lines = [f"Сэмплов: {total}"]
+        for name, count in own.most_common(limit):
+            lines.append(f"{count * 100 / max(total, 1):5.1f}%  {name}")
+        return '\n'.join(lines)
+
+profiler = SamplingProfiler()
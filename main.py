@@ -1,69 +1,165 @@
 import asyncio
 import logging
 import hashlib
-import random
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.types import InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import setup_application
 from aiohttp import web
 import os
 from dotenv import load_dotenv
 from database import *
+from match_queue import RandomMatchQueue, CriteriaMatchQueue, PostgresMatchQueue, PAIRING_WAIT
+from send_scheduler import SendScheduler, PRIORITY_RELAY, PRIORITY_SYSTEM, PRIORITY_MODERATOR
+from metrics import registry, Counter, Gauge, Histogram
+from instrumentation import update_timing, handler_timing, api_timing, profiler, current_trace
+from webhook_lanes import WebhookLanes
+from report_digest import ReportDigest
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 MODERATOR_ID = int(os.getenv("MODERATOR_ID", "0"))
 MOD_SECRET = os.getenv("MOD_SECRET", "")
 HASH_SALT = os.getenv("HASH_SALT", "default_salt_change_me")
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка нагрузочного теста)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "0.5"))
+# memory — случайные пары в процессе (один воркер), criteria — подбор по языку и возрасту в процессе,
+# postgres — общая очередь для нескольких воркеров
+MATCH_QUEUE_BACKEND = os.getenv("MATCH_QUEUE_BACKEND", "memory")
+# Через сколько секунд ожидания критерии подбора ослабляются и сколько прошлых собеседников не повторять
+MATCH_RELAX_AFTER = float(os.getenv("MATCH_RELAX_AFTER", "15"))
+MATCH_HISTORY = int(os.getenv("MATCH_HISTORY", "3"))
+SEARCH_STALE_MINUTES = int(os.getenv("SEARCH_STALE_MINUTES", "30"))
+# Контроль нагрузки: сколько апдейтов обрабатывается одновременно и сколько апдейт ждёт своей очереди
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "50"))
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", "5"))
+# Окно, за которое жалобы собираются в одно уведомление модератору
+REPORT_DIGEST_WINDOW = float(os.getenv("REPORT_DIGEST_WINDOW", "30"))
+AUTO_BAN_REPORTS = int(os.getenv("AUTO_BAN_REPORTS", "5"))
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN not found in environment variables")
 
-bot = Bot(token=BOT_TOKEN)
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 logging.basicConfig(level=logging.INFO)
 
 def hash_id(user_id):
     return hashlib.sha256(f"{user_id}{HASH_SALT}".encode()).hexdigest()[:16]
 
-class RandomMatchQueue:
-    def __init__(self):
-        self._users = set()
-        self._lock = asyncio.Lock()
-  
-    async def add(self, user_id):
-        async with self._lock:
-            if user_id not in self._users:
-                self._users.add(user_id)
-                logging.info(f"User {user_id} added to queue. Queue size: {len(self._users)}")
-                return True
-        return False
-  
-    async def remove(self, user_id):
-        async with self._lock:
-            if user_id in self._users:
-                self._users.remove(user_id)
-                logging.info(f"User {user_id} removed from queue. Queue size: {len(self._users)}")
-                return True
-        return False
-  
-    async def get_random_pair(self):
-        async with self._lock:
-            if len(self._users) < 2:
-                return None, None
-            users_list = list(self._users)
-            user1, user2 = random.sample(users_list, 2)
-            self._users.remove(user1)
-            self._users.remove(user2)
-            logging.info(f"Random pair created: {user1} and {user2}. Queue size: {len(self._users)}")
-            return user1, user2
-  
-    def __len__(self):
-        return len(self._users)
-
-searching_queue = RandomMatchQueue()
+# Подбор по критериям включается явно: он меняет хвост ожидания (до 2 * MATCH_RELAX_AFTER) на качество пар
+MATCH_BY_CRITERIA = MATCH_QUEUE_BACKEND == "criteria"
+if MATCH_QUEUE_BACKEND == "postgres":
+    searching_queue = PostgresMatchQueue()
+elif MATCH_BY_CRITERIA:
+    searching_queue = CriteriaMatchQueue(relax_after=MATCH_RELAX_AFTER, history=MATCH_HISTORY)
+else:
+    searching_queue = RandomMatchQueue()
+send_scheduler = SendScheduler(
+    global_rate=float(os.getenv("SEND_GLOBAL_RATE", "30")),
+    chat_rate=float(os.getenv("SEND_CHAT_RATE", "1")),
+    chat_burst=int(os.getenv("SEND_CHAT_BURST", "3")),
+    workers=int(os.getenv("SEND_WORKERS", "8")),
+    max_queue=int(os.getenv("SEND_QUEUE_LIMIT", "10000")),
+    max_retries=int(os.getenv("SEND_MAX_RETRIES", "3")),
+)
+
+# --- Метрики ---
+WEBHOOK_BACKLOG = Gauge('bot_webhook_backlog', 'Updates accepted by the webhook and not yet processed',
+                        function=lambda: webhook_lanes.size())
+QUEUE_LENGTH = Gauge('bot_search_queue_length', 'Users waiting in the search queue',
+                     function=lambda: searching_queue.size())
+MESSAGES_RELAYED = Counter('bot_messages_relayed_total', 'Messages relayed between partners', ['media_type'])
+PAIRING_LATENCY = Histogram('bot_pairing_seconds', 'Time to commit a pairing and notify both users')
+SEND_QUEUE_DEPTH = Gauge('bot_send_queue_depth', 'Outbound messages waiting in the send scheduler',
+                         function=lambda: send_scheduler.depth)
+SEND_FAILURES = Counter('bot_send_failures_total', 'Outbound messages that failed with an API error',
+                        function=lambda: send_scheduler.failed)
+SEND_DROPPED = Counter('bot_send_dropped_total', 'Outbound messages dropped (queue full or retries exhausted)',
+                       function=lambda: send_scheduler.dropped)
+
+UPDATES_IN_FLIGHT = Gauge('bot_updates_in_flight', 'Updates admitted and currently being processed')
+UPDATES_SHED = Counter('bot_updates_shed_total', 'Updates dropped by admission control', ['reason'])
+
+async def metrics_handler(request):
+    return web.Response(text=await registry.render(), content_type="text/plain", charset="utf-8")
+
+# --- Контроль нагрузки ---
+# Второстепенные запросы (статистика, правила, списки модератора) отбрасываются первыми:
+# сразу, если пул БД занят, и без ожидания в очереди на обработку. Переписка ждёт до ADMISSION_TIMEOUT.
+# В режиме вебхука параллелизм ограничен числом полос, поэтому второстепенное отбрасывается ещё
+# на входе в полосу — если перед ним уже есть очередь.
+LOW_PRIORITY_TEXTS = {"📊 Статистика", "📜 Правила", "/stats", "/user", "/reports"}
+LOW_PRIORITY_CALLBACKS = {"mod_reports", "mod_stats"}
+BUSY_TEXT = "⏳ Сервис перегружен, попробуйте чуть позже."
+admission = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+
+def is_low_priority(update):
+    if update.message is not None and update.message.text:
+        text = update.message.text
+        # Кнопка сравнивается целиком (в «📊 Статистика» первое слово — эмодзи),
+        # у команды — только сама команда без аргументов и @имени бота
+        if text.startswith('/'):
+            text = text.split(maxsplit=1)[0].split('@', 1)[0]
+        return text in LOW_PRIORITY_TEXTS
+    if update.callback_query is not None:
+        return (update.callback_query.data or '').split(':', 1)[0] in LOW_PRIORITY_CALLBACKS
+    return False
+
+async def shed(update, reason):
+    UPDATES_SHED.inc(reason=reason)
+    logging.warning(f"Shedding update {update.update_id} ({reason})")
+    if update.message is not None:
+        await safe_send_message(update.message.chat.id, BUSY_TEXT)
+    elif update.callback_query is not None:
+        try:
+            await update.callback_query.answer(BUSY_TEXT, show_alert=True)
+        except Exception as e:
+            logging.error(f"Error answering shed callback: {e}")
+
+async def admission_control(handler, event, data):
+    low_priority = is_low_priority(event)
+    if low_priority and (pool_saturated() or admission.locked()):
+        await shed(event, 'low_priority')
+        return
+    try:
+        await asyncio.wait_for(admission.acquire(), timeout=ADMISSION_TIMEOUT)
+    except asyncio.TimeoutError:
+        await shed(event, 'timeout')
+        return
+    UPDATES_IN_FLIGHT.inc()
+    try:
+        return await handler(event, data)
+    finally:
+        UPDATES_IN_FLIGHT.dec()
+        admission.release()
+
+def shed_at_lane(update, backlog):
+    return is_low_priority(update) and (backlog > 0 or pool_saturated())
+
+webhook_lanes = WebhookLanes(
+    dp, bot,
+    lanes=int(os.getenv("WEBHOOK_LANES", "32")),
+    depth=int(os.getenv("WEBHOOK_LANE_DEPTH", "100")),
+    should_shed=shed_at_lane,
+    on_shed=lambda update: shed(update, 'lane_backlog'),
+)
+
+dp.update.outer_middleware(update_timing)
+dp.update.outer_middleware(admission_control)
+dp.message.middleware(handler_timing)
+dp.callback_query.middleware(handler_timing)
+bot.session.middleware(api_timing)
+bot.session.middleware(send_scheduler.throttle)
 
 # --- Клавиатуры ---
 def get_main_menu():
@@ -99,94 +195,219 @@ def get_mod_menu():
         [InlineKeyboardButton(text="📈 Статистика", callback_data="mod_stats")],
     ])
 
+# --- Контекст апдейта ---
+# Пользователь и статус бана загружаются один раз на апдейт и передаются в хендлеры
+@dp.message.outer_middleware()
+async def load_user_context(handler, event, data):
+    user_id = event.from_user.id
+    data['user'] = await get_user(user_id)
+    if data['user'] is LOOKUP_FAILED:
+        # Состояние пользователя неизвестно: хендлеры не запускаем, чтобы не перезаписать его
+        # как у нового пользователя (state='menu', повторная постановка в поиск)
+        UPDATES_SHED.inc(reason='user_lookup')
+        await safe_send_message(user_id, BUSY_TEXT)
+        return None
+    data['banned'] = user_id != MODERATOR_ID and await is_banned(user_id)
+    if data['user'] is not None:
+        activity.touch(user_id)
+    if data['user'] is not None and MATCH_BY_CRITERIA:
+        # Язык клиента — критерий подбора; пишем только когда он изменился
+        language = (event.from_user.language_code or '')[:2] or None
+        if data['user'].get('language') != language:
+            await update_user(user_id, language=language)
+            data['user']['language'] = language
+    return await handler(event, data)
+
+# --- Очередь поиска ---
+def match_criteria(user):
+    return (user.get('language'), user.get('age_group')) if user else None
+
+async def enqueue(user_id, user=None, requeue=False):
+    # В очередь — вместе с критериями подбора из строки пользователя.
+    # requeue — возврат после несостоявшейся пары: старшинство в очереди сохраняется
+    if user is None:
+        user = await get_user(user_id)
+        if user is LOOKUP_FAILED:
+            user = None
+    add = searching_queue.requeue if requeue else searching_queue.add
+    return await add(user_id, match_criteria(user))
+
 # --- Проверка бана ---
-async def check_ban(user_id):
-    if user_id == MODERATOR_ID:
-        return False
-    if await is_banned(user_id):
-        await bot.send_message(user_id, "❌ Вы заблокированы в системе.\n\nОбратитесь к модератору для разблокировки.")
+async def check_ban(user_id, banned):
+    if banned:
+        await safe_send_message(user_id, "❌ Вы заблокированы в системе.\n\nОбратитесь к модератору для разблокировки.")
         return True
     return False
 
+def format_duration(chat_start):
+    if not chat_start:
+        return ""
+    total_seconds = int((datetime.now() - chat_start).total_seconds())
+    return f"{total_seconds // 60}м {total_seconds % 60}с"
+
 # --- Безопасная отправка ---
-async def safe_send_message(chat_id, text, reply_markup=None):
+# Все исходящие сообщения идут через планировщик с учётом лимитов Telegram
+async def safe_send_message(chat_id, text, reply_markup=None, priority=PRIORITY_SYSTEM):
+    # Только ставим в очередь отправки: доставку не ждём, иначе чат на паузе по RetryAfter
+    # или по своему бакету задерживает вызывающего (цикл подбора, хендлер).
+    # Возвращается future с результатом — его можно дождаться там, где он действительно нужен
+    return send_scheduler.submit(
+        chat_id, lambda: bot.send_message(chat_id, text, reply_markup=reply_markup), priority
+    )
+
+async def notify_moderator(text, priority=PRIORITY_MODERATOR):
+    return await safe_send_message(MODERATOR_ID, text, priority=priority)
+
+report_digest = ReportDigest(notify_moderator, window=REPORT_DIGEST_WINDOW)
+
+# --- Пересылка медиа ---
+def build_forward(chat_id, message):
+    if message.text:
+        return lambda: bot.send_message(chat_id, message.text)
+    elif message.photo:
+        return lambda: bot.send_photo(chat_id, message.photo[-1].file_id, caption=message.caption)
+    elif message.video:
+        return lambda: bot.send_video(chat_id, message.video.file_id, caption=message.caption)
+    elif message.voice:
+        return lambda: bot.send_voice(chat_id, message.voice.file_id)
+    elif message.audio:
+        return lambda: bot.send_audio(chat_id, message.audio.file_id, caption=message.caption)
+    elif message.document:
+        return lambda: bot.send_document(chat_id, message.document.file_id, caption=message.caption)
+    elif message.sticker:
+        return lambda: bot.send_sticker(chat_id, message.sticker.file_id)
+    elif message.video_note:
+        return lambda: bot.send_video_note(chat_id, message.video_note.file_id)
+    elif message.animation:
+        return lambda: bot.send_animation(chat_id, message.animation.file_id, caption=message.caption)
+    elif message.location:
+        return lambda: bot.send_location(chat_id, message.location.latitude, message.location.longitude)
+    elif message.contact:
+        return lambda: bot.send_contact(chat_id, message.contact.phone_number, message.contact.first_name)
+    return None
+
+def safe_forward_media(chat_id, message):
+    # Ставим в очередь отправки и сразу возвращаем future: воркер полосы вебхука
+    # не должен стоять, пока чат собеседника ждёт своего бакета или RetryAfter
+    send = build_forward(chat_id, message)
+    if send is None:
+        return None
+    MESSAGES_RELAYED.inc(media_type=getattr(message.content_type, 'value', message.content_type))
+    return send_scheduler.submit(chat_id, send, PRIORITY_RELAY)
+
+def watch_relay(future, sender_id):
+    # Результат доставки приходит позже: о неудаче сообщаем отправителю из колбэка
+    def done(future):
+        if future.cancelled() or future.exception() is not None or not future.result():
+            asyncio.create_task(safe_send_message(sender_id, "❌ Ошибка отправки сообщения."))
+    if future is not None:
+        future.add_done_callback(done)
+
+# --- Альбомы ---
+# Части одного альбома приходят отдельными апдейтами: копим их ALBUM_WINDOW секунд
+# и отправляем одним send_media_group. Окно закрывает таймер, а не хендлер первой части,
+# поэтому остальные части и другие апдейты пользователя не ждут его в полосе вебхука
+album_buffers = {}
+
+def album_item(message):
+    if message.photo:
+        return InputMediaPhoto(media=message.photo[-1].file_id, caption=message.caption)
+    elif message.video:
+        return InputMediaVideo(media=message.video.file_id, caption=message.caption)
+    elif message.document:
+        return InputMediaDocument(media=message.document.file_id, caption=message.caption)
+    elif message.audio:
+        return InputMediaAudio(media=message.audio.file_id, caption=message.caption)
+    return None
+
+def forward_album(chat_id, message):
+    key = (message.from_user.id, message.media_group_id)
+    buffered = album_buffers.get(key)
+    if buffered is not None:
+        buffered.append(message)
+        return
+    album_buffers[key] = [message]
+    asyncio.get_running_loop().call_later(ALBUM_WINDOW, flush_album, key, chat_id)
+
+def flush_album(key, chat_id):
+    messages = sorted(album_buffers.pop(key, ()), key=lambda m: m.message_id)
     try:
-        await bot.send_message(chat_id, text, reply_markup=reply_markup)
-        return True
+        media = [item for item in map(album_item, messages) if item is not None]
+        if len(media) < 2:
+            futures = [safe_forward_media(chat_id, m) for m in messages]
+        else:
+            MESSAGES_RELAYED.inc(media_type='media_group')
+            futures = [send_scheduler.submit(chat_id, lambda: bot.send_media_group(chat_id, media), PRIORITY_RELAY)]
+        for future in futures:
+            watch_relay(future, key[0])
     except Exception as e:
-        logging.error(f"Failed to send message to {chat_id}: {e}")
-        return False
+        logging.error(f"Error forwarding album {key[1]} from {key[0]}: {e}")
 
-# --- Пересылка медиа ---
-async def safe_forward_media(chat_id, message):
+# --- Поиск ---
+async def match_pair(user1, user2):
     try:
-        if message.text:
-            await bot.send_message(chat_id, message.text)
-        elif message.photo:
-            await bot.send_photo(chat_id, message.photo[-1].file_id, caption=message.caption)
-        elif message.video:
-            await bot.send_video(chat_id, message.video.file_id, caption=message.caption)
-        elif message.voice:
-            await bot.send_voice(chat_id, message.voice.file_id)
-        elif message.audio:
-            await bot.send_audio(chat_id, message.audio.file_id, caption=message.caption)
-        elif message.document:
-            await bot.send_document(chat_id, message.document.file_id, caption=message.caption)
-        elif message.sticker:
-            await bot.send_sticker(chat_id, message.sticker.file_id)
-        elif message.video_note:
-            await bot.send_video_note(chat_id, message.video_note.file_id)
-        elif message.animation:
-            await bot.send_animation(chat_id, message.animation.file_id, caption=message.caption)
-        elif message.location:
-            await bot.send_location(chat_id, message.location.latitude, message.location.longitude)
-        elif message.contact:
-            await bot.send_contact(chat_id, message.contact.phone_number, message.contact.first_name)
-        return True
+        with PAIRING_LATENCY.time():
+            return await commit_pair(user1, user2)
     except Exception as e:
-        logging.error(f"Failed to forward media to {chat_id}: {e}")
+        logging.error(f"Error pairing users: {e}")
+        await enqueue(user1, requeue=True)
+        await enqueue(user2, requeue=True)
         return False
 
-# --- Поиск ---
+async def commit_pair(user1, user2):
+    if await pair_users(user1, user2):
+        searching_queue.matched(user1, user2)
+        await safe_send_message(user1,
+            "🎉 Собеседник найден! Начинайте общение!\n\n"
+            "💬 Теперь вы можете обмениваться:\n"
+            "• Текстовыми сообщениями\n• Фотографиями\n• Видео\n• Голосовыми сообщениями\n"
+            "• Музыкой\n• Стикерами\n• Файлами\n• И многим другим!",
+            reply_markup=get_chat_menu()
+        )
+        await safe_send_message(user2,
+            "🎉 Собеседник найден! Начинайте общение!\n\n"
+            "💬 Теперь вы можете обмениваться:\n"
+            "• Текстовыми сообщениями\n• Фотографиями\n• Видео\n• Голосовыми сообщениями\n"
+            "• Музыкой\n• Стикерами\n• Файлами\n• И многим другим!",
+            reply_markup=get_chat_menu()
+        )
+        return True
+    # Кто-то успел отменить поиск — возвращаем в очередь оставшегося
+    for user_id in (user1, user2):
+        data = await get_user(user_id)
+        if data is LOOKUP_FAILED:
+            logging.error(f"Can't re-queue {user_id} after failed pairing: user lookup failed")
+        elif data and data['state'] == 'searching':
+            await enqueue(user_id, data, requeue=True)
+    return True
+
+async def restore_search_queue():
+    # После рестарта возвращаем в очередь всех, кто остался в состоянии 'searching'
+    started = time.monotonic()
+    stale = await reset_stale_searching(SEARCH_STALE_MINUTES)
+    restored = 0
+    try:
+        async for row in iter_searching_users():
+            if await searching_queue.add(row['tg_id'], match_criteria(row)):
+                restored += 1
+    except Exception as e:
+        logging.error(f"Error restoring search queue: {e}")
+    logging.info(
+        f"Search queue restored: {restored} users re-queued, {stale} stale reset to menu "
+        f"in {time.monotonic() - started:.3f}s"
+    )
+
 async def start_search_loop():
     logging.info("Random search loop started")
     try:
         while True:
-            user1, user2 = await searching_queue.get_random_pair()
-            if user1 and user2:
-                try:
-                    u1_data = await get_user(user1)
-                    u2_data = await get_user(user2)
-                    if not u1_data or not u2_data:
-                        continue
-                    if u1_data['state'] == 'searching' and u2_data['state'] == 'searching':
-                        now = datetime.now()
-                        await update_user(user1, partner_id=user2, state='chat', chat_start=now)
-                        await update_user(user2, partner_id=user1, state='chat', chat_start=now)
-                        await safe_send_message(user1,
-                            "🎉 Собеседник найден! Начинайте общение!\n\n"
-                            "💬 Теперь вы можете обмениваться:\n"
-                            "• Текстовыми сообщениями\n• Фотографиями\n• Видео\n• Голосовыми сообщениями\n"
-                            "• Музыкой\n• Стикерами\n• Файлами\n• И многим другим!",
-                            reply_markup=get_chat_menu()
-                        )
-                        await safe_send_message(user2,
-                            "🎉 Собеседник найден! Начинайте общение!\n\n"
-                            "💬 Теперь вы можете обмениваться:\n"
-                            "• Текстовыми сообщениями\n• Фотографиями\n• Видео\n• Голосовыми сообщениями\n"
-                            "• Музыкой\n• Стикерами\n• Файлами\n• И многим другим!",
-                            reply_markup=get_chat_menu()
-                        )
-                    else:
-                        if u1_data['state'] == 'searching':
-                            await searching_queue.add(user1)
-                        if u2_data['state'] == 'searching':
-                            await searching_queue.add(user2)
-                except Exception as e:
-                    logging.error(f"Error pairing users: {e}")
-                    await searching_queue.add(user1)
-                    await searching_queue.add(user2)
-            await asyncio.sleep(0.5)
+            await searching_queue.wait_for_pair()
+            # За один проход разбираем всех, кого можно соединить
+            pairs = await searching_queue.drain_pairs()
+            results = await asyncio.gather(*(match_pair(u1, u2) for u1, u2 in pairs))
+            if not all(results):
+                # БД недоступна — не крутимся вхолостую на возвращённых в очередь
+                await asyncio.sleep(1)
     except asyncio.CancelledError:
         logging.info("Search loop stopped")
     except Exception as e:
@@ -196,7 +417,7 @@ async def start_search_loop():
 # КОМАНДЫ
 # ================================
 @dp.message(Command("start"))
-async def start(message: types.Message):
+async def start(message: types.Message, banned):
     user_id = message.from_user.id
     if user_id == MODERATOR_ID:
         await update_user(user_id, state='menu')
@@ -206,17 +427,45 @@ async def start(message: types.Message):
             reply_markup=get_main_menu()
         )
         return
-    if await check_ban(user_id):
+    if await check_ban(user_id, banned):
         return
     await update_user(user_id, state='menu')
     await message.answer(
         "👋 Привет! Добро пожаловать в анонимный чат!\n\n"
         "💬 Здесь вы можете:\n"
         "• Найти случайного собеседника\n• Общаться анонимно\n• Обмениваться разными типами сообщений\n\n"
+        "🎂 /age — указать возрастную группу для подбора\n\n"
         "🎯 Выберите действие в меню ниже:",
         reply_markup=get_main_menu()
     )
 
+AGE_GROUPS = ("до 18", "18-24", "25-34", "35+")
+
+@dp.message(Command("age"))
+async def cmd_age(message: types.Message, user):
+    user_id = message.from_user.id
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        current = user['age_group'] if user and user.get('age_group') else "не указана"
+        await message.answer(
+            f"🎂 Возрастная группа: {current}\n\n"
+            f"📝 Использование: /age <группа>\n"
+            f"Группы: {', '.join(AGE_GROUPS)}\n"
+            f"/age - — сбросить\n\n"
+            f"Собеседника сначала ищем в вашей группе, при долгом ожидании — среди всех."
+        )
+        return
+    value = args[1].strip()
+    if value == "-":
+        await update_user(user_id, age_group=None)
+        await message.answer("✅ Возрастная группа сброшена.")
+        return
+    if value not in AGE_GROUPS:
+        await message.answer(f"❌ Неизвестная группа. Доступны: {', '.join(AGE_GROUPS)}")
+        return
+    await update_user(user_id, age_group=value)
+    await message.answer(f"✅ Возрастная группа: {value}\nУчтём при следующем поиске.")
+
 @dp.message(Command("mod"))
 async def mod_panel(message: types.Message):
     user_id = message.from_user.id
@@ -233,7 +482,10 @@ async def mod_panel(message: types.Message):
         f"⚙️ Доступные команды:\n"
         f"/ban <ID> — заблокировать пользователя\n"
         f"/unban <ID> — разблокировать пользователя\n"
-        f"/user <ID> — информация о пользователе",
+        f"/user <ID> — информация о пользователе\n"
+        f"/reports [ID] — жалобы, все или на пользователя\n"
+        f"/syncbans — перечитать баны из базы\n"
+        f"/profile on|off — семплирующий профайлер",
         reply_markup=get_mod_menu()
     )
 
@@ -272,6 +524,34 @@ async def cmd_unban(message: types.Message):
     except ValueError:
         await message.answer("❌ Неверный формат ID.")
 
+@dp.message(Command("syncbans"))
+async def cmd_syncbans(message: types.Message):
+    if message.from_user.id != MODERATOR_ID:
+        return
+    count = await load_bans()
+    if count is None:
+        await message.answer("❌ Не удалось перечитать баны.")
+        return
+    await message.answer(f"✅ Индекс банов пересобран. Активных банов: {count}")
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    if message.from_user.id != MODERATOR_ID:
+        return
+    args = message.text.split()
+    action = args[1] if len(args) > 1 else "status"
+    if action == "on":
+        started = profiler.start()
+        await message.answer("▶️ Профайлер запущен." if started else "⏳ Профайлер уже работает.")
+    elif action == "off":
+        if not profiler.stop():
+            await message.answer("❌ Профайлер не запущен.")
+            return
+        await message.answer(f"⏹️ Профайлер остановлен.\n\n{profiler.report()}")
+    else:
+        state = "работает" if profiler.running else "остановлен"
+        await message.answer(f"📈 Профайлер {state}.\n\n{profiler.report()}")
+
 @dp.message(Command("user"))
 async def cmd_user(message: types.Message):
     if message.from_user.id != MODERATOR_ID:
@@ -282,25 +562,43 @@ async def cmd_user(message: types.Message):
         return
     try:
         target_id = int(args[1])
-        reports = await get_user_reports(target_id)
-        count = await get_reports_count(target_id)
-        is_ban = await is_banned(target_id)
+        dossier = await get_user_dossier(target_id)
+        if dossier is None:
+            await message.answer("❌ Ошибка получения данных.")
+            return
+        reports = dossier['reports']
         text = f"👤 Пользователь: `{target_id}`\n\n"
-        text += f"📨 Жалоб: {count}\n"
-        text += f"🚫 Статус: {'Заблокирован' if is_ban else 'Активен'}\n\n"
+        text += f"📨 Жалоб: {dossier['reports_count']}\n"
+        text += f"🚫 Статус: {'Заблокирован' if dossier['banned_until'] else 'Активен'}\n\n"
         if reports:
             text += "📋 Последние жалобы:\n"
-            for r in reports[:5]:
+            for r in reports:
                 from_id = r['from_id']
                 reason = r['reason'] or "Причина не указана"
                 time_str = r['timestamp'].strftime('%d.%m %H:%M')
                 text += f"• От {from_id}: {reason} [{time_str}]\n"
         else:
             text += "✅ Жалоб нет."
-        await message.answer(text, parse_mode="Markdown")
+        markup = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📨 Все жалобы", callback_data=reports_callback(target_id))]
+        ]) if reports else None
+        await message.answer(text, parse_mode="Markdown", reply_markup=markup)
     except ValueError:
         await message.answer("❌ Неверный формат ID.")
 
+@dp.message(Command("reports"))
+async def cmd_reports(message: types.Message):
+    if message.from_user.id != MODERATOR_ID:
+        return
+    args = message.text.split()
+    try:
+        to_id = int(args[1]) if len(args) > 1 else None
+    except ValueError:
+        await message.answer("❌ Неверный формат ID.")
+        return
+    text, markup = await render_reports_page(reports_callback(to_id))
+    await message.answer(text or "✅ Жалоб нет", reply_markup=markup)
+
 @dp.message(Command("stats"))
 async def user_stats(message: types.Message):
     user_id = message.from_user.id
@@ -318,16 +616,40 @@ async def user_stats(message: types.Message):
     )
     await message.answer(text)
 
-@dp.message(lambda m: m.text == "📊 Статистика")
-async def stats_button(message: types.Message):
+# ================================
+# КНОПКИ
+# ================================
+# Маршрутизация кнопок по словарю (состояние, текст) -> хендлер вместо цепочки фильтров.
+# Состояние None — маршрут для любого состояния, если нет более точного.
+BUTTON_ROUTES = {}
+
+def button(text, *states):
+    def decorator(func):
+        for state in states or (None,):
+            BUTTON_ROUTES[(state, text)] = func
+        return func
+    return decorator
+
+@dp.message(lambda m: (None, m.text) in BUTTON_ROUTES)
+async def route_buttons(message: types.Message, user, banned):
+    state = user['state'] if user else None
+    route = BUTTON_ROUTES.get((state, message.text)) or BUTTON_ROUTES[(None, message.text)]
+    # В метриках апдейт учитывается под именем конкретной кнопки, а не роутера
+    trace = current_trace.get()
+    if trace is not None:
+        trace.handler = route.__name__
+    await route(message, user, banned)
+
+@button("📊 Статистика")
+async def stats_button(message: types.Message, user, banned):
     await user_stats(message)
 
-@dp.message(lambda m: m.text == "🆔 Мой ID")
-async def my_id(message: types.Message):
+@button("🆔 Мой ID")
+async def my_id(message: types.Message, user, banned):
     await message.answer(f"🆔 Ваш идентификатор:\n\n`{message.from_user.id}`", parse_mode="Markdown")
 
-@dp.message(lambda m: m.text == "📜 Правила")
-async def rules(message: types.Message):
+@button("📜 Правила")
+async def rules(message: types.Message, user, banned):
     await message.answer(
         "📜 Правила анонимного чата:\n\n"
         "🔹 1. Запрещён нецензурный язык\n"
@@ -340,79 +662,81 @@ async def rules(message: types.Message):
         reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="🔙 Назад")]], resize_keyboard=True)
     )
 
-@dp.message(lambda m: m.text == "🔙 Назад")
-async def back_to_menu(message: types.Message):
+@button("🔙 Назад")
+async def back_to_menu(message: types.Message, user, banned):
     user_id = message.from_user.id
     await update_user(user_id, state='menu')
     await message.answer("🔙 Возврат в главное меню:", reply_markup=get_main_menu())
 
-@dp.message(lambda m: m.text == "🔍 Найти собеседника")
-async def search(message: types.Message):
+@button("🔍 Найти собеседника")
+async def search(message: types.Message, user, banned):
     user_id = message.from_user.id
-    if await check_ban(user_id):
-        return
-    user_data = await get_user(user_id)
-    if user_data and user_data['state'] == 'chat':
-        await message.answer("💬 Вы уже в чате! Завершите текущий диалог сначала.")
+    if await check_ban(user_id, banned):
         return
     await update_user(user_id, state='searching')
-    added = await searching_queue.add(user_id)
+    added = await enqueue(user_id, user)
     if added:
         await message.answer("🔍 Ищем собеседника...\n\n⏳ Пожалуйста, подождите", reply_markup=get_searching_menu())
     else:
         await message.answer("⏳ Вы уже в очереди поиска!")
 
-@dp.message(lambda m: m.text == "❌ Отмена поиска")
-async def cancel_anything(message: types.Message):
-    user_id = message.from_user.id
-    user = await get_user(user_id)
+@button("🔍 Найти собеседника", 'chat', 'reporting')
+async def search_in_chat(message: types.Message, user, banned):
+    await message.answer("💬 Вы уже в чате! Завершите текущий диалог сначала.")
+
+@button("❌ Отмена поиска")
+async def nothing_to_cancel(message: types.Message, user, banned):
     if not user:
         return
-    
-    # Если пользователь в режиме жалобы
-    if user['state'] == 'reporting':
-        await update_user(user_id, state='chat')
-        await message.answer("❌ Жалоба отменена.", reply_markup=get_chat_menu())
+    await message.answer("❌ Нечего отменять.", reply_markup=get_main_menu())
+
+@button("❌ Отмена поиска", 'reporting')
+async def cancel_report(message: types.Message, user, banned):
+    await update_user(message.from_user.id, state='chat')
+    await message.answer("❌ Жалоба отменена.", reply_markup=get_chat_menu())
+
+@button("❌ Отмена поиска", 'searching')
+async def cancel_search(message: types.Message, user, banned):
+    user_id = message.from_user.id
+    await searching_queue.remove(user_id)
+    cancelled = await cancel_searching(user_id)
+    if cancelled is LOOKUP_FAILED:
+        # Состояние в БД осталось 'searching' — возвращаем в очередь, чтобы не зависнуть вне её
+        await enqueue(user_id, user)
+        await message.answer(BUSY_TEXT)
         return
-    
-    # Если пользователь в режиме поиска
-    if user['state'] == 'searching':
-        await searching_queue.remove(user_id)
-        await update_user(user_id, state='menu')
-        await message.answer("❌ Поиск отменён.", reply_markup=get_main_menu())
+    if not cancelled:
+        # Цикл подбора успел соединить пару между удалением из очереди и этой записью
+        await message.answer("💬 Собеседник уже найден — вы в чате.", reply_markup=get_chat_menu())
         return
-    
-    await message.answer("❌ Нечего отменять.", reply_markup=get_main_menu())
+    await message.answer("❌ Поиск отменён.", reply_markup=get_main_menu())
 
 # ================================
 # ЧАТ
 # ================================
-@dp.message(lambda m: m.text in ["⏹️ Завершить", "➡️ Следующий", "🚫 Пожаловаться"])
-async def handle_chat_buttons(message: types.Message):
+@button("⏹️ Завершить")
+@button("➡️ Следующий")
+@button("🚫 Пожаловаться")
+async def not_in_chat(message: types.Message, user, banned):
+    await message.answer("🔍 Сначала найдите собеседника.")
+
+@button("⏹️ Завершить", 'chat')
+@button("➡️ Следующий", 'chat')
+async def leave_chat(message: types.Message, user, banned):
     user_id = message.from_user.id
-    user = await get_user(user_id)
-    if not user or user['state'] != 'chat':
+    ending = message.text == "⏹️ Завершить"
+    result = await (end_chat(user_id) if ending else next_chat(user_id))
+    if result is LOOKUP_FAILED:
+        await message.answer(BUSY_TEXT)
+        return
+    if result is None:
         await message.answer("🔍 Сначала найдите собеседника.")
         return
+    partner_id = result['partner_id']
+    duration_text = format_duration(result['chat_start'])
 
-    partner_id = user['partner_id']
-    chat_start = user.get('chat_start')
-    duration_text = ""
-
-    if chat_start:
-        duration = datetime.now() - chat_start
-        total_seconds = int(duration.total_seconds())
-        minutes = total_seconds // 60
-        seconds = total_seconds % 60
-        duration_text = f"{minutes}м {seconds}с"
-
-        # Логируем в БД
-        await log_chat_end(user_id, partner_id, duration)
-
-    if message.text == "⏹️ Завершить":
-        await update_user(user_id, partner_id=None, state='menu', chat_start=None)
-        if partner_id:
-            await update_user(partner_id, partner_id=None, state='menu', chat_start=None)
+    if ending:
+        if result['partner_linked']:
             await safe_send_message(partner_id, "💬 Собеседник завершил диалог.", reply_markup=get_main_menu())
         await searching_queue.remove(user_id)
         text = "💬 Диалог завершён."
@@ -421,89 +745,123 @@ async def handle_chat_buttons(message: types.Message):
         await message.answer(text, reply_markup=get_main_menu())
         return
 
-    if message.text == "➡️ Следующий":
-        if partner_id:
-            await update_user(partner_id, partner_id=None, state='menu', chat_start=None)
-            await safe_send_message(partner_id, "💬 Собеседник начал поиск нового партнёра.", reply_markup=get_main_menu())
-        await update_user(user_id, partner_id=None, state='searching', chat_start=None)
-        await searching_queue.add(user_id)
-        text = "🔍 Ищем нового собеседника..."
-        if duration_text:
-            text += f"\n⏱️ Предыдущий диалог: {duration_text}"
-        await message.answer(text, reply_markup=get_searching_menu())
-        return
-
-    if message.text == "🚫 Пожаловаться":
-        if not partner_id:
-            await message.answer("❌ Нет активного чата для жалобы.")
-            return
-        await message.answer(
-            "📝 Опишите причину жалобы:",
-            reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="❌ Отмена поиска")]], resize_keyboard=True)
-        )
-        await update_user(user_id, state='reporting')
+    if result['partner_linked']:
+        await safe_send_message(partner_id, "💬 Собеседник начал поиск нового партнёра.", reply_markup=get_main_menu())
+    await enqueue(user_id, user)
+    text = "🔍 Ищем нового собеседника..."
+    if duration_text:
+        text += f"\n⏱️ Предыдущий диалог: {duration_text}"
+    await message.answer(text, reply_markup=get_searching_menu())
+
+@button("🚫 Пожаловаться", 'chat')
+async def start_report(message: types.Message, user, banned):
+    if not user['partner_id']:
+        await message.answer("❌ Нет активного чата для жалобы.")
         return
+    await message.answer(
+        "📝 Опишите причину жалобы:",
+        reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="❌ Отмена поиска")]], resize_keyboard=True)
+    )
+    await update_user(message.from_user.id, state='reporting')
 
 # ================================
 # ОБРАБОТКА СООБЩЕНИЙ
 # ================================
 @dp.message()
-async def handle_messages(message: types.Message):
+async def handle_messages(message: types.Message, user):
     user_id = message.from_user.id
-    user = await get_user(user_id)
     if not user:
         await update_user(user_id, state='menu')
         return
 
-    # Обработка отмены жалобы
-    if user['state'] == 'reporting' and message.text == "❌ Отмена поиска":
-        await update_user(user_id, state='chat')
-        await message.answer("❌ Жалоба отменена. Продолжайте общение.", reply_markup=get_chat_menu())
-        return
-
     if user['state'] == 'reporting':
         reason = message.text.strip()
         if not reason or len(reason) < 5:
             await message.answer("❌ Причина жалобы должна содержать не менее 5 символов.\nПопробуйте еще раз:")
             return
-        partner_id = user['partner_id']
+        result = await close_chat_with_report(user_id, reason)
+        if result is LOOKUP_FAILED:
+            # Состояние осталось 'reporting': пользователь может отправить причину ещё раз
+            await message.answer(BUSY_TEXT)
+            return
+        partner_id = result['partner_id'] if result else None
         if not partner_id:
-            await message.answer("💬 Чат уже завершён.")
-            await update_user(user_id, state='menu')
+            await message.answer("💬 Чат уже завершён.", reply_markup=get_main_menu())
             return
-        await add_report(user_id, partner_id, reason)
-        await update_user(user_id, state='menu', partner_id=None)
-        await update_user(partner_id, state='menu', partner_id=None)
         await message.answer("✅ Жалоба отправлена. Чат завершён.", reply_markup=get_main_menu())
-        await safe_send_message(partner_id, "💬 Диалог завершён из-за жалобы от собеседника.", reply_markup=get_main_menu())
+        if result['partner_linked']:
+            await safe_send_message(partner_id, "💬 Диалог завершён из-за жалобы от собеседника.", reply_markup=get_main_menu())
 
         reports_count = await get_reports_count(partner_id)
         if MODERATOR_ID:
-            await safe_send_message(
-                MODERATOR_ID,
-                f"🚫 НОВАЯ ЖАЛОБА\n\n"
-                f"👤 От: {user_id}\n"
-                f"🎯 На: {partner_id}\n"
-                f"📝 Причина: {reason}\n"
-                f"📊 Всего жалоб: {reports_count}"
-            )
-            if reports_count >= 5:
+            if reports_count >= AUTO_BAN_REPORTS and not await is_banned(partner_id):
+                # О блокировке сообщаем сразу, мимо дайджеста
                 await ban_user_permanent(partner_id)
-                await safe_send_message(
-                    MODERATOR_ID,
+                report_digest.discard(partner_id)
+                await notify_moderator(
                     f"🔨 АВТОМАТИЧЕСКАЯ БЛОКИРОВКА!\n"
-                    f"Пользователь {partner_id} заблокирован за многочисленные жалобы."
+                    f"Пользователь {partner_id} заблокирован за многочисленные жалобы ({reports_count}).\n"
+                    f"📝 Последняя причина: {reason}",
+                    priority=PRIORITY_SYSTEM
                 )
                 await safe_send_message(partner_id, "❌ Вы были заблокированы за многочисленные жалобы.")
+            else:
+                report_digest.add(partner_id, user_id, reason, reports_count)
         return
 
     if user['state'] == 'chat' and user['partner_id']:
         try:
-            await safe_forward_media(user['partner_id'], message)
+            if message.media_group_id:
+                forward_album(user['partner_id'], message)
+            else:
+                watch_relay(safe_forward_media(user['partner_id'], message), user_id)
         except Exception as e:
             logging.error(f"Error forwarding message: {e}")
             await message.answer("❌ Ошибка отправки сообщения.")
 
+# --- Просмотр жалоб ---
+# Курсор страницы живёт в callback_data (до 64 байт):
+# mod_reports[:<to_id>[:<o|n>:<микросекунды>:<id>]], to_id = 0 — все пользователи
+REPORTS_PAGE_SIZE = 10
+EPOCH = datetime(1970, 1, 1)
+
+def reports_callback(to_id, direction=None, row=None):
+    data = f"mod_reports:{to_id or 0}"
+    if row is not None:
+        data += f":{direction}:{(row['timestamp'] - EPOCH) // timedelta(microseconds=1)}:{row['id']}"
+    return data
+
+def parse_reports_callback(data):
+    parts = data.split(':')
+    to_id = int(parts[1]) if len(parts) > 1 and parts[1] != '0' else None
+    if len(parts) < 5:
+        return to_id, None, False
+    cursor = (EPOCH + timedelta(microseconds=int(parts[3])), int(parts[4]))
+    return to_id, cursor, parts[2] == 'n'
+
+async def render_reports_page(data):
+    to_id, cursor, newer = parse_reports_callback(data)
+    rows, has_more = await get_reports_page(to_id, cursor, newer, REPORTS_PAGE_SIZE)
+    if not rows:
+        return None, None
+    has_newer = has_more if newer else cursor is not None
+    has_older = True if newer else has_more
+    title = f"📨 ЖАЛОБЫ НА {to_id}:\n" if to_id else "📨 ПОСЛЕДНИЕ ЖАЛОБЫ:\n"
+    text_lines = [title]
+    for r in rows:
+        text_lines.append(f"👤 {r['from_id']} → 🎯 {r['to_id']}")
+        text_lines.append(f"📝 {r['reason'] or 'Причина не указана'}")
+        text_lines.append(f"🕒 {r['timestamp'].strftime('%d.%m %H:%M')}\n")
+    pager = []
+    if has_newer:
+        pager.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=reports_callback(to_id, 'n', rows[0])))
+    if has_older:
+        pager.append(InlineKeyboardButton(text="Старее ➡️", callback_data=reports_callback(to_id, 'o', rows[-1])))
+    keyboard = [pager] if pager else []
+    keyboard.append([InlineKeyboardButton(text="🔄 Обновить", callback_data=data)])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="mod_back")])
+    return "\n".join(text_lines), InlineKeyboardMarkup(inline_keyboard=keyboard)
+
 # ================================
 # МОДЕРАТОРСКАЯ ПАНЕЛЬ
 # ================================
@@ -514,22 +872,13 @@ async def mod_callbacks(callback: types.CallbackQuery):
         return
     data = callback.data
 
-    if data == "mod_reports":
+    if data.startswith("mod_reports"):
         try:
-            reports = await get_all_reports()
-            if not reports:
+            new_text, new_markup = await render_reports_page(data)
+            if new_text is None:
                 await callback.message.edit_text("✅ Жалоб нет", reply_markup=get_mod_menu())
+                await callback.answer()
                 return
-            text_lines = ["📨 ПОСЛЕДНИЕ ЖАЛОБЫ:\n"]
-            for r in reports[:15]:
-                text_lines.append(f"👤 {r['from_id']} → 🎯 {r['to_id']}")
-                text_lines.append(f"📝 {r['reason'] or 'Причина не указана'}")
-                text_lines.append(f"🕒 {r['timestamp'].strftime('%d.%m %H:%M')}\n")
-            new_text = "\n".join(text_lines)
-            new_markup = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔄 Обновить", callback_data="mod_reports")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="mod_back")]
-            ])
             if (callback.message.text or "") == new_text:
                 await callback.answer("Список не изменился", show_alert=False)
                 return
@@ -544,15 +893,26 @@ async def mod_callbacks(callback: types.CallbackQuery):
 
     elif data == "mod_stats":
         total_users, active_chats, total_reports = await get_stats()
-        in_queue = len(searching_queue)
+        in_queue = await searching_queue.size()
         reports_today = await get_reports_today()
+        cache = user_cache.stats()
+        sends = send_scheduler.stats()
+        paired, waited = PAIRING_WAIT.snapshot()
+        avg_wait = waited / paired if paired else 0
         text = (
             f"📊 СТАТИСТИКА СИСТЕМЫ\n\n"
             f"👥 Пользователей: {total_users}\n"
             f"💬 Активных чатов: {active_chats}\n"
             f"🔍 В поиске: {in_queue}\n"
             f"📨 Всего жалоб: {total_reports}\n"
-            f"📅 Сегодня: {reports_today}"
+            f"📅 Сегодня: {reports_today}\n"
+            f"✉️ Переслано сообщений: {int(MESSAGES_RELAYED.total())}\n"
+            f"⏳ Среднее ожидание собеседника: {avg_wait:.1f}с\n\n"
+            f"🗄 Кэш сессий: {cache['size']}/{user_cache.max_size}\n"
+            f"✅ Попаданий: {cache['hits']} • ❌ Промахов: {cache['misses']} • ♻️ Вытеснений: {cache['evictions']}\n"
+            f"📤 Очередь отправки: {sends['depth']} • Повторов: {sends['retried']} • Потеряно: {sends['dropped']}\n"
+            f"🚦 В обработке: {int(UPDATES_IN_FLIGHT.value())}/{MAX_CONCURRENT_UPDATES} • "
+            f"Отброшено: {int(UPDATES_SHED.total())} • Таймаутов пула: {int(DB_POOL_TIMEOUTS.total())}"
         )
         await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔙 Назад", callback_data="mod_back")]
@@ -569,27 +929,46 @@ async def mod_callbacks(callback: types.CallbackQuery):
 async def on_startup(app):
     logging.info("Starting bot...")
     await init_db()
+    send_scheduler.start()
+    write_buffer.start()
+    activity.start()
+    if MATCH_QUEUE_BACKEND == "postgres":
+        await enable_cache_sync()
+    await searching_queue.start()
+    await restore_search_queue()
     await unban_user(MODERATOR_ID)
+    webhook_lanes.start()
     webhook_url = f"https://{os.getenv('RENDER_SERVICE_NAME')}.onrender.com/webhook"
     await bot.set_webhook(webhook_url)
     logging.info(f"Webhook set to: {webhook_url}")
     asyncio.create_task(start_search_loop())
+    asyncio.create_task(chat_log_maintenance_loop())
     logging.info("Bot started!")
 
 async def on_shutdown(app):
     logging.info("Shutting down...")
+    # Сначала дорабатываем принятые апдейты: они ещё пишут в БД и отправляют сообщения
+    await webhook_lanes.close()
+    await report_digest.close()
+    await send_scheduler.close()
+    await write_buffer.close()
+    await activity.close()
+    await close_db()
     await bot.session.close()
 
-def main():
+def create_app():
     app = web.Application()
-    webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
-    webhook_handler.register(app, path="/webhook")
+    app.router.add_post("/webhook", webhook_lanes.handle)
     setup_application(app, dp, bot=bot)
     app.router.add_get("/health", lambda r: web.Response(text="OK"))
+    app.router.add_get("/metrics", metrics_handler)
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
+    return app
+
+def main():
     port = int(os.getenv("PORT", 10000))
-    web.run_app(app, host="0.0.0.0", port=port)
+    web.run_app(create_app(), host="0.0.0.0", port=port)
 
 if __name__ == "__main__":
     main()
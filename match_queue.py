@@ -0,0 +1,382 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+
+import database
+from metrics import Histogram
+
+PAIRING_WAIT = Histogram(
+    'bot_pairing_wait_seconds', 'Time a user waited in the search queue before being paired',
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600),
+)
+
+class MatchQueue:
+    # Общий интерфейс очереди поиска для цикла подбора и хендлеров
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def add(self, user_id, criteria=None):
+        # criteria — (язык, возрастная группа); очереди без критериев их игнорируют
+        raise NotImplementedError
+
+    async def remove(self, user_id):
+        raise NotImplementedError
+
+    async def requeue(self, user_id, criteria=None):
+        # Возврат в очередь после несостоявшейся пары; очереди со старшинством сохраняют прежнее время постановки
+        return await self.add(user_id, criteria)
+
+    async def drain_pairs(self, k=None):
+        raise NotImplementedError
+
+    async def wait_for_pair(self):
+        raise NotImplementedError
+
+    async def size(self):
+        raise NotImplementedError
+
+    async def get_random_pair(self):
+        pairs = await self.drain_pairs(1)
+        return pairs[0] if pairs else (None, None)
+
+    def matched(self, user1, user2):
+        # Пара подтверждена в БД — очереди с историей собеседников её запоминают
+        pass
+
+class RandomMatchQueue(MatchQueue):
+    # Плотный массив + индекс: случайный выбор, добавление и удаление за O(1)
+    def __init__(self):
+        self._users = []
+        self._index = {}
+        self._since = {}
+        self._lock = asyncio.Lock()
+        self._ready = asyncio.Condition(self._lock)
+
+    def _push(self, user_id):
+        self._index[user_id] = len(self._users)
+        self._users.append(user_id)
+        self._since[user_id] = time.monotonic()
+
+    def _pop_at(self, pos):
+        # Удаление перестановкой с последним элементом
+        user_id = self._users[pos]
+        last = self._users.pop()
+        if last != user_id:
+            self._users[pos] = last
+            self._index[last] = pos
+        del self._index[user_id]
+        del self._since[user_id]
+        return user_id
+
+    def _pop_random(self):
+        pos = random.randrange(len(self._users))
+        PAIRING_WAIT.observe(time.monotonic() - self._since[self._users[pos]])
+        return self._pop_at(pos)
+
+    async def add(self, user_id, criteria=None):
+        async with self._lock:
+            if user_id not in self._index:
+                self._push(user_id)
+                logging.info(f"User {user_id} added to queue. Queue size: {len(self._users)}")
+                if len(self._users) >= 2:
+                    self._ready.notify_all()
+                return True
+        return False
+
+    async def remove(self, user_id):
+        async with self._lock:
+            pos = self._index.get(user_id)
+            if pos is not None:
+                self._pop_at(pos)
+                logging.info(f"User {user_id} removed from queue. Queue size: {len(self._users)}")
+                return True
+        return False
+
+    async def get_random_pair(self):
+        async with self._lock:
+            if len(self._users) < 2:
+                return None, None
+            user1 = self._pop_random()
+            user2 = self._pop_random()
+            logging.info(f"Random pair created: {user1} and {user2}. Queue size: {len(self._users)}")
+            return user1, user2
+
+    async def drain_pairs(self, k=None):
+        # До k случайных пар за один захват блокировки (k=None — все возможные)
+        async with self._lock:
+            available = len(self._users) // 2
+            count = available if k is None else min(k, available)
+            pairs = [(self._pop_random(), self._pop_random()) for _ in range(count)]
+            if pairs:
+                logging.info(f"Drained {len(pairs)} pairs. Queue size: {len(self._users)}")
+            return pairs
+
+    async def wait_for_pair(self):
+        # Просыпаемся сразу после add(), без периодического опроса
+        async with self._ready:
+            await self._ready.wait_for(lambda: len(self._users) >= 2)
+
+    async def size(self):
+        return len(self._users)
+
+    def __contains__(self, user_id):
+        return user_id in self._index
+
+    def __len__(self):
+        return len(self._users)
+
+class CriteriaMatchQueue(MatchQueue):
+    # Подбор по критериям (язык, возрастная группа) с приоритетом дольше всех ждущих.
+    # Каждый ждущий лежит в трёх корзинах: строгой (язык, возраст), по языку и общей.
+    # Корзина — OrderedDict в порядке постановки, так что самый старый кандидат берётся за O(1).
+    # Новичка сразу сводим со старейшим в его строгой корзине; кто ждёт дольше relax_after,
+    # ищет уже по одному языку, дольше 2 * relax_after — среди всех.
+    # Последние history собеседников пользователя повторно не подбираются.
+    LEVELS = 3
+
+    def __init__(self, relax_after=15.0, history=3, max_histories=100000, clock=time.monotonic):
+        self.relax_after = relax_after
+        self.history = history
+        self.max_histories = max_histories
+        self.clock = clock
+        self.matches = [0] * self.LEVELS
+        self._criteria = {}
+        self._buckets = [{} for _ in range(self.LEVELS)]
+        self._all = self._buckets[-1][()] = OrderedDict()
+        self._pending = deque()
+        # Время постановки тех, кого drain_pairs уже выдал в пару, до подтверждения в matched()
+        self._claimed = {}
+        self._recent = OrderedDict()
+        self._lock = asyncio.Lock()
+        self._ready = asyncio.Condition(self._lock)
+
+    def _key(self, criteria, level):
+        # Уровень 0 — оба критерия, 1 — только язык, 2 — без критериев
+        return criteria[:self.LEVELS - 1 - level]
+
+    def _push(self, user_id, criteria, since=None):
+        restored = since is not None
+        if not restored:
+            since = self.clock()
+        self._criteria[user_id] = criteria
+        for level, buckets in enumerate(self._buckets):
+            bucket = buckets.setdefault(self._key(criteria, level), OrderedDict())
+            bucket[user_id] = since
+            if restored:
+                # Корзины упорядочены по since: вставших позже переносим за возвращённого.
+                # Их немного — только пришедшие, пока пара не подтвердилась
+                newer = []
+                for other in reversed(bucket):
+                    if other != user_id:
+                        if bucket[other] <= since:
+                            break
+                        newer.append(other)
+                for other in reversed(newer):
+                    bucket.move_to_end(other)
+        self._pending.append(user_id)
+
+    def _pop(self, user_id):
+        criteria = self._criteria.pop(user_id)
+        since = self._all[user_id]
+        for level, buckets in enumerate(self._buckets):
+            key = self._key(criteria, level)
+            bucket = buckets[key]
+            del bucket[user_id]
+            if not bucket and key:
+                del buckets[key]
+        return since
+
+    def _is_recent(self, user_id, other):
+        return other in self._recent.get(user_id, ()) or user_id in self._recent.get(other, ())
+
+    def _find(self, user_id, level):
+        # Старейший подходящий кандидат: пропускаем только себя и недавних собеседников,
+        # поэтому длина просмотра не зависит от размера очереди
+        bucket = self._buckets[level].get(self._key(self._criteria[user_id], level), ())
+        for other in bucket:
+            if other != user_id and not self._is_recent(user_id, other):
+                return other
+        return None
+
+    def _match(self, user1, user2, level):
+        now = self.clock()
+        for user_id in (user1, user2):
+            since = self._claimed[user_id] = self._pop(user_id)
+            PAIRING_WAIT.observe(now - since)
+        self.matches[level] += 1
+        return user1, user2
+
+    def _remember(self, user_id, partner_id):
+        recent = self._recent.get(user_id)
+        if recent is None:
+            recent = self._recent[user_id] = deque(maxlen=self.history)
+        self._recent.move_to_end(user_id)
+        recent.append(partner_id)
+        while len(self._recent) > self.max_histories:
+            self._recent.popitem(last=False)
+
+    def matched(self, user1, user2):
+        self._claimed.pop(user1, None)
+        self._claimed.pop(user2, None)
+        if self.history > 0:
+            self._remember(user1, user2)
+            self._remember(user2, user1)
+
+    async def add(self, user_id, criteria=None):
+        # Новая постановка — прежнее время из несостоявшейся пары уже не в счёт
+        self._claimed.pop(user_id, None)
+        return await self._add(user_id, criteria)
+
+    async def requeue(self, user_id, criteria=None):
+        return await self._add(user_id, criteria, self._claimed.pop(user_id, None))
+
+    async def _add(self, user_id, criteria, since=None):
+        async with self._lock:
+            if user_id in self._criteria:
+                return False
+            self._push(user_id, tuple(criteria) if criteria else (None, None), since)
+            logging.info(f"User {user_id} added to queue {criteria}. Queue size: {len(self._all)}")
+            if len(self._all) >= 2:
+                self._ready.notify_all()
+            return True
+
+    async def remove(self, user_id):
+        async with self._lock:
+            if user_id not in self._criteria:
+                return False
+            self._pop(user_id)
+            logging.info(f"User {user_id} removed from queue. Queue size: {len(self._all)}")
+            return True
+
+    async def drain_pairs(self, k=None):
+        async with self._lock:
+            pairs = []
+            now = self.clock()
+            # Сначала те, кто ждёт дольше relax_after: от самых старых, критерии ослаблены по сроку ожидания.
+            # Без пары здесь остаются только те, кому подходят лишь недавние собеседники, — префикс короткий
+            overdue = []
+            for user_id, since in self._all.items():
+                if now - since < self.relax_after:
+                    break
+                overdue.append((user_id, since))
+            for user_id, since in overdue:
+                if k is not None and len(pairs) >= k:
+                    break
+                if user_id not in self._criteria:
+                    continue
+                allowed = min(int((now - since) // self.relax_after), self.LEVELS - 1)
+                for level in range(allowed + 1):
+                    partner = self._find(user_id, level)
+                    if partner is not None:
+                        pairs.append(self._match(user_id, partner, level))
+                        break
+            # Новички: строгий подбор со старейшим в своей корзине
+            while self._pending and (k is None or len(pairs) < k):
+                user_id = self._pending.popleft()
+                if user_id not in self._criteria:
+                    continue
+                partner = self._find(user_id, 0)
+                if partner is not None:
+                    pairs.append(self._match(partner, user_id, 0))
+            if pairs:
+                logging.info(f"Matched {len(pairs)} pairs. Queue size: {len(self._all)}")
+            return pairs
+
+    def _next_deadline(self):
+        # Через сколько секунд ближайшему из ждущих пора ослабить критерии. Сроки у каждого свои —
+        # since + relax_after и since + 2 * relax_after, — а _all упорядочен по since, поэтому
+        # хватает прохода до первого, кто ещё ни разу не ослаблял: дальше сроки только позже.
+        # Ищущие среди всех новых сроков не дают — их будит add(), а раз в relax_after проверяем на всякий случай
+        if len(self._all) < 2:
+            return None
+        now = self.clock()
+        deadline = None
+        for since in self._all.values():
+            level = int((now - since) // self.relax_after)
+            if level >= self.LEVELS - 1:
+                continue
+            at = since + (level + 1) * self.relax_after
+            if deadline is None or at < deadline:
+                deadline = at
+            if level == 0:
+                break
+        if deadline is None:
+            return self.relax_after
+        return max(deadline - now, 0.05)
+
+    async def wait_for_pair(self):
+        # Просыпаемся на add() или когда кому-то из ждущих пора ослабить критерии
+        async with self._ready:
+            if self._pending and len(self._all) >= 2:
+                return
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout=self._next_deadline())
+            except asyncio.TimeoutError:
+                pass
+
+    async def size(self):
+        return len(self._all)
+
+    def __contains__(self, user_id):
+        return user_id in self._criteria
+
+    def __len__(self):
+        return len(self._all)
+
+class PostgresMatchQueue(MatchQueue):
+    # Очередь в таблице search_queue: общая для всех процессов бота.
+    # Кандидатов забираем через FOR UPDATE SKIP LOCKED, соседей будим через LISTEN/NOTIFY.
+    def __init__(self, batch_size=200, fallback_interval=5.0):
+        self.batch_size = batch_size
+        self.fallback_interval = fallback_interval
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+
+    async def start(self):
+        await database.listen(database.QUEUE_CHANNEL, self._on_notify)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self._wakeup.set()
+
+    async def add(self, user_id, criteria=None):
+        added = await database.queue_add(user_id)
+        if added:
+            logging.info(f"User {user_id} added to shared queue")
+        return added
+
+    async def remove(self, user_id):
+        removed = await database.queue_remove(user_id)
+        if removed:
+            logging.info(f"User {user_id} removed from shared queue")
+        return removed
+
+    async def drain_pairs(self, k=None):
+        limit = self.batch_size if k is None else min(k, self.batch_size // 2) * 2
+        claimed = await database.queue_claim(limit)
+        for _, waited in claimed:
+            PAIRING_WAIT.observe(waited)
+        claimed = [user_id for user_id, _ in claimed]
+        random.shuffle(claimed)
+        pairs = list(zip(claimed[::2], claimed[1::2]))
+        if pairs:
+            logging.info(f"Claimed {len(pairs)} pairs from shared queue")
+            if k is None and len(claimed) == limit:
+                # Взяли полный пакет — в очереди может остаться ещё
+                self._wakeup.set()
+        return pairs
+
+    async def wait_for_pair(self):
+        # Уведомление может потеряться при переподключении — страхуемся таймаутом
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.fallback_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def size(self):
+        return await database.queue_size()
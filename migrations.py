@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import re
+
+# Версионированные миграции схемы. Каждая запись: (версия, описание, список запросов).
+# Запросы с CONCURRENTLY выполняются вне транзакции, остальные — в одной транзакции на версию.
+MIGRATIONS = [
+    (1, "base schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            tg_id BIGINT PRIMARY KEY,
+            state TEXT DEFAULT 'menu',
+            partner_id BIGINT,
+            chat_start TIMESTAMP,
+            last_search_msg_id BIGINT,
+            last_active TIMESTAMP DEFAULT NOW(),
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS reports (
+            id SERIAL PRIMARY KEY,
+            from_id BIGINT,
+            to_id BIGINT,
+            reason TEXT,
+            timestamp TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bans (
+            tg_id BIGINT PRIMARY KEY,
+            until TIMESTAMP,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_logs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            partner_id BIGINT,
+            duration INTERVAL,
+            ended_at TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+        'ALTER TABLE reports ADD COLUMN IF NOT EXISTS reason TEXT',
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS chat_start TIMESTAMP',
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS last_search_msg_id BIGINT',
+    ]),
+    (2, "shared search queue", [
+        '''
+        CREATE TABLE IF NOT EXISTS search_queue (
+            tg_id BIGINT PRIMARY KEY,
+            enqueued_at TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+    ]),
+    (3, "user_stats rollup", [
+        '''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id BIGINT PRIMARY KEY,
+            chat_count INTEGER NOT NULL DEFAULT 0,
+            total_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            last_chat TIMESTAMP
+        )
+        ''',
+        # Если таблица уже была заполнена раньше, существующие строки не трогаем
+        '''
+        INSERT INTO user_stats (user_id, chat_count, total_seconds, last_chat)
+        SELECT user_id, COUNT(*), COALESCE(SUM(EXTRACT(EPOCH FROM duration)), 0), MAX(ended_at)
+        FROM chat_logs
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO NOTHING
+        ''',
+    ]),
+    (4, "hot-path indexes", [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reports_to_id ON reports (to_id)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reports_timestamp ON reports (timestamp)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_logs_user_id ON chat_logs (user_id)',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_state_active ON users (state)
+        WHERE state IN ('searching', 'chat')
+        ''',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_search_queue_enqueued ON search_queue (enqueued_at)',
+    ]),
+    # Курсорная пагинация жалоб: общий список и список по пользователю идут по (timestamp, id).
+    # Старые одноколоночные индексы — префиксы новых, их удаляем
+    (5, "report keyset indexes", [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reports_timestamp_id ON reports (timestamp, id)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reports_to_id_timestamp_id ON reports (to_id, timestamp, id)',
+        'DROP INDEX CONCURRENTLY IF EXISTS idx_reports_timestamp',
+        'DROP INDEX CONCURRENTLY IF EXISTS idx_reports_to_id',
+    ]),
+    # chat_logs секционируется по месяцам ended_at. Старая таблица переливается целиком в одной
+    # транзакции миграции; секции создаются функцией, которую дальше вызывает фоновая задача.
+    # Секция по умолчанию принимает строки, если секцию месяца не успели создать, — COPY не падает;
+    # новая секция месяца забирает свои строки из неё и только потом подключается
+    (6, "monthly chat_logs partitions", [
+        '''
+        CREATE OR REPLACE FUNCTION create_chat_logs_partition(month DATE) RETURNS TEXT AS $$
+        DECLARE
+            first_day DATE := date_trunc('month', month);
+            partition_name TEXT := 'chat_logs_' || to_char(first_day, 'YYYYMM');
+        BEGIN
+            IF to_regclass(partition_name) IS NOT NULL THEN
+                RETURN partition_name;
+            END IF;
+            EXECUTE format('CREATE TABLE %I (LIKE chat_logs INCLUDING DEFAULTS)', partition_name);
+            IF to_regclass('chat_logs_default') IS NOT NULL THEN
+                EXECUTE format('WITH moved AS (DELETE FROM chat_logs_default WHERE ended_at >= %L AND ended_at < %L RETURNING *) '
+                               'INSERT INTO %I SELECT * FROM moved',
+                               first_day, first_day + INTERVAL '1 month', partition_name);
+            END IF;
+            EXECUTE format('ALTER TABLE chat_logs ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, first_day, first_day + INTERVAL '1 month');
+            RETURN partition_name;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'ALTER TABLE chat_logs RENAME TO chat_logs_legacy',
+        '''
+        CREATE TABLE chat_logs (
+            id BIGINT NOT NULL DEFAULT nextval('chat_logs_id_seq'),
+            user_id BIGINT,
+            partner_id BIGINT,
+            duration INTERVAL,
+            ended_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (id, ended_at)
+        ) PARTITION BY RANGE (ended_at)
+        ''',
+        # Иначе последовательность удалится вместе со старой таблицей; id теперь BIGINT — и она тоже
+        'ALTER SEQUENCE chat_logs_id_seq OWNED BY chat_logs.id',
+        'ALTER SEQUENCE chat_logs_id_seq AS bigint',
+        'CREATE TABLE chat_logs_default PARTITION OF chat_logs DEFAULT',
+        '''
+        SELECT create_chat_logs_partition(month::date)
+        FROM generate_series(
+            date_trunc('month', COALESCE((SELECT MIN(ended_at) FROM chat_logs_legacy), NOW())),
+            date_trunc('month', NOW()) + INTERVAL '2 months',
+            INTERVAL '1 month'
+        ) AS month
+        ''',
+        '''
+        INSERT INTO chat_logs (id, user_id, partner_id, duration, ended_at)
+        SELECT id, user_id, partner_id, duration, COALESCE(ended_at, NOW()) FROM chat_logs_legacy
+        ''',
+        'DROP TABLE chat_logs_legacy',
+        'CREATE INDEX IF NOT EXISTS idx_chat_logs_user_id ON chat_logs (user_id)',
+        # Дневные агрегаты по секциям, удалённым по сроку хранения
+        '''
+        CREATE TABLE IF NOT EXISTS chat_logs_daily (
+            day DATE PRIMARY KEY,
+            chat_count BIGINT NOT NULL DEFAULT 0,
+            user_count BIGINT NOT NULL DEFAULT 0,
+            total_seconds DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+        ''',
+    ]),
+    # Критерии подбора: язык клиента Telegram и возрастная группа, которую пользователь выбирает сам
+    (7, "match criteria", [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS language TEXT',
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS age_group TEXT',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+LOCK_POLL_INTERVAL = 0.5
+CONCURRENT_INDEX = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)', re.IGNORECASE)
+
+async def current_version(conn):
+    if await conn.fetchval("SELECT to_regclass('schema_version')") is None:
+        return 0
+    return await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+
+async def drop_invalid_index(conn, sql):
+    # Упавший CREATE INDEX CONCURRENTLY оставляет INVALID-индекс, и IF NOT EXISTS при повторе его пропустит:
+    # индекс так и не заработает. Перед повтором такой индекс удаляем
+    match = CONCURRENT_INDEX.search(sql)
+    if match is None:
+        return
+    invalid = await conn.fetchval('''
+        SELECT c.oid::regclass::text FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = $1 AND c.relnamespace = current_schema()::regnamespace AND NOT i.indisvalid
+    ''', match.group(1))
+    if invalid is not None:
+        logging.warning(f"Dropping invalid index {invalid} left by an interrupted migration")
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {invalid}')
+
+async def migrate(conn):
+    # Обычный старт — два SELECT и никакого DDL
+    version = await current_version(conn)
+    if version >= LATEST_VERSION:
+        return version
+    # Несколько воркеров могут стартовать одновременно — мигрирует один.
+    # Блокировку не ждём внутри pg_advisory_lock: такой запрос держит снимок, и CREATE INDEX CONCURRENTLY
+    # у мигрирующего воркера ждал бы его вечно. Пробуем короткими запросами и спим между попытками
+    waited = 0.0
+    while not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext('schema_migrations'))"):
+        if waited == 0.0:
+            logging.info("Another worker is applying migrations, waiting")
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        waited += LOCK_POLL_INTERVAL
+    try:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        version = await current_version(conn)
+        for number, name, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            logging.info(f"Applying migration {number}: {name}")
+            if any('CONCURRENTLY' in sql for sql in statements):
+                for sql in statements:
+                    await drop_invalid_index(conn, sql)
+                    await conn.execute(sql)
+                await conn.execute('INSERT INTO schema_version (version, name) VALUES ($1, $2)', number, name)
+            else:
+                async with conn.transaction():
+                    for sql in statements:
+                        await conn.execute(sql)
+                    await conn.execute('INSERT INTO schema_version (version, name) VALUES ($1, $2)', number, name)
+            version = number
+        return version
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from collections import deque
+
+# Длина одного сообщения Telegram — 4096 единиц UTF-16 (эмодзи — две); оставляем запас под строку «… и ещё N»
+MAX_UNITS = 4000
+MAX_TARGETS = 20
+MAX_REASON = 100
+
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+class ReportDigest:
+    # Уведомления о жалобах копятся window секунд и уходят модератору одним сообщением:
+    # «пользователь X: +7 жалоб» вместо семи отдельных алертов
+    def __init__(self, send, window=30, reasons_per_target=3):
+        self.send = send
+        self.window = window
+        self.reasons_per_target = reasons_per_target
+        self._pending = {}
+        self._task = None
+
+    def add(self, target_id, reporter_id, reason, total):
+        entry = self._pending.get(target_id)
+        if entry is None:
+            entry = self._pending[target_id] = {
+                'count': 0, 'total': 0, 'reasons': deque(maxlen=self.reasons_per_target),
+            }
+        entry['count'] += 1
+        entry['total'] = total
+        entry['reasons'].append((reporter_id, reason))
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+
+    def discard(self, target_id):
+        # Пользователь уже заблокирован — отдельный алерт ушёл сразу
+        self._pending.pop(target_id, None)
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            return
+        self._task = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            # send только ставит сообщение в очередь — ждём результат доставки, чтобы не потерять отказ
+            delivery = await self.send(self.render(pending))
+            if not await delivery:
+                logging.error(f"Report digest for {len(pending)} users was not delivered")
+        except Exception as e:
+            logging.error(f"Error sending report digest for {len(pending)} users: {e}")
+
+    def render(self, pending):
+        # Цели добавляются целиком, пока текст укладывается в MAX_UNITS; остальные — одной строкой в конце.
+        # Причины уже обрезаны до MAX_REASON, но длинные ID и эмодзи всё равно могут переполнить сообщение
+        targets = sorted(pending.items(), key=lambda item: -item[1]['count'])
+        reports = sum(entry['count'] for entry in pending.values())
+        text = f"🚫 ЖАЛОБЫ: {reports} за {self.window:g}с\n"
+        size = utf16_len(text)
+        shown = 0
+        for target_id, entry in targets[:MAX_TARGETS]:
+            lines = [f"🎯 {target_id}: +{entry['count']} (всего {entry['total']})"]
+            for reporter_id, reason in entry['reasons']:
+                if len(reason) > MAX_REASON:
+                    reason = reason[:MAX_REASON] + "…"
+                lines.append(f"   • От {reporter_id}: {reason}")
+            block = '\n' + '\n'.join(lines)
+            if size + utf16_len(block) > MAX_UNITS:
+                break
+            text += block
+            size += utf16_len(block)
+            shown += 1
+        if shown < len(targets):
+            text += f"\n\n… и ещё {len(targets) - shown} пользователей"
+        return text
@@ -0,0 +1,221 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter
+
+# Классы приоритета: меньше — важнее
+PRIORITY_RELAY = 0
+PRIORITY_SYSTEM = 1
+PRIORITY_MODERATOR = 2
+
+# Вызов Bot API идёт из воркера планировщика: токены уже взяты, повтор — его забота
+_from_worker = contextvars.ContextVar('send_scheduler_worker', default=False)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # Сколько секунд ждать до появления токена (0 — можно отправлять)
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'send', 'future', 'attempts')
+
+    def __init__(self, priority, seq, send, future):
+        self.priority = priority
+        self.seq = seq
+        self.send = send
+        self.future = future
+        self.attempts = 0
+
+class SendScheduler:
+    # Общий токен-бакет на бота, бакеты на каждый чат, приоритеты и повтор по RetryAfter.
+    # Внутри одного чата порядок отправки сохраняется (FIFO).
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, workers=8,
+                 max_queue=10000, max_retries=3, max_buckets=50000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self._chats = {}
+        self._scheduled = set()
+        self._ready = []
+        self._has_ready = asyncio.Event()
+        self._seq = itertools.count()
+        self._tasks = []
+        self.depth = 0
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout=5):
+        # Даём очереди догрузиться, затем останавливаем воркеров
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, chat_id, send, priority=PRIORITY_SYSTEM):
+        # send — функция без аргументов, возвращающая корутину вызова Bot API
+        future = asyncio.get_running_loop().create_future()
+        if self.depth >= self.max_queue:
+            self.dropped += 1
+            logging.warning(f"Send queue full ({self.depth}), dropping message to {chat_id}")
+            future.set_result(False)
+            return future
+        job = _Job(priority, next(self._seq), send, future)
+        self._chats.setdefault(chat_id, deque()).append(job)
+        self.depth += 1
+        if chat_id not in self._scheduled:
+            self._scheduled.add(chat_id)
+            self._make_ready(chat_id)
+        return future
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                # Полный бакет ничем не отличается от нового — такие можно забыть
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.is_full()}
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _make_ready(self, chat_id, delay=None):
+        queue = self._chats.get(chat_id)
+        if not queue:
+            self._chats.pop(chat_id, None)
+            self._scheduled.discard(chat_id)
+            return
+        if delay is None:
+            delay = self._bucket(chat_id).delay()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._make_ready, chat_id)
+            return
+        head = queue[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._has_ready.set()
+
+    async def throttle(self, make_request, bot, method):
+        # Middleware сессии бота: прямые ответы хендлеров (message.answer, edit_text) мимо очереди
+        # тоже тратят общий и чатовый бакеты, иначе общий лимит недосчитывает реальный трафик.
+        # По RetryAfter такой вызов ждёт и повторяется, как и сообщения из очереди
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None or _from_worker.get():
+            return await make_request(bot, method)
+        attempts = 0
+        while True:
+            await self._take_direct(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempts += 1
+                if attempts > self.max_retries:
+                    self.dropped += 1
+                    raise
+                self.retried += 1
+                logging.warning(f"Rate limited on direct call to {chat_id}, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+
+    async def _take_direct(self, chat_id):
+        bucket = self._bucket(chat_id)
+        while True:
+            delay = max(self._global.delay(), bucket.delay())
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self._global.take()
+        bucket.take()
+
+    async def _worker(self):
+        _from_worker.set(True)
+        while True:
+            if not self._ready:
+                self._has_ready.clear()
+                await self._has_ready.wait()
+                continue
+            delay = self._global.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if not self._ready:
+                continue
+            self._global.take()
+            _, _, chat_id = heapq.heappop(self._ready)
+            job = self._chats[chat_id].popleft()
+            self.depth -= 1
+            await self._run(chat_id, job)
+
+    async def _run(self, chat_id, job):
+        self._bucket(chat_id).take()
+        try:
+            await job.send()
+        except TelegramRetryAfter as e:
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                self.dropped += 1
+                logging.error(f"Giving up on message to {chat_id} after {job.attempts} attempts")
+                job.future.set_result(False)
+                self._make_ready(chat_id)
+                return
+            # Чат ставим на паузу, сообщение остаётся первым в его очереди
+            self.retried += 1
+            self._chats[chat_id].appendleft(job)
+            self.depth += 1
+            logging.warning(f"Rate limited on {chat_id}, retrying in {e.retry_after}s")
+            self._make_ready(chat_id, delay=e.retry_after)
+            return
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Failed to send to {chat_id}: {e}")
+            job.future.set_result(False)
+            self._make_ready(chat_id)
+            return
+        self.sent += 1
+        job.future.set_result(True)
+        self._make_ready(chat_id)
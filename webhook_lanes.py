@@ -0,0 +1,97 @@
+import asyncio
+import logging
+
+from aiogram.types import Update
+from aiohttp import web
+
+from metrics import Counter, Gauge
+
+LANE_DEPTH = Gauge('bot_webhook_lane_depth', 'Updates waiting in a webhook worker lane', ['lane'])
+LANE_REJECTED = Counter('bot_webhook_rejected_total', 'Updates answered with 503 because their lane was full')
+
+class WebhookLanes:
+    # Вебхук отвечает Telegram сразу, а апдейт уходит в одну из полос воркеров.
+    # Полоса выбирается по from_user.id: апдейты одного пользователя обрабатываются строго
+    # по порядку, разные пользователи — параллельно. Глубина полосы ограничена: при переполнении
+    # отвечаем 503, и Telegram повторит доставку позже.
+    # should_shed(update, backlog) решает, отбросить ли апдейт сразу, не ставя в полосу с backlog апдейтами;
+    # on_shed(update) — корутина, которая сообщает пользователю об отказе
+    def __init__(self, dispatcher, bot, lanes=32, depth=100, should_shed=None, on_shed=None):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.lanes = lanes
+        self.depth = depth
+        self.should_shed = should_shed
+        self.on_shed = on_shed
+        self._queues = []
+        self._tasks = []
+        self._closing = False
+
+    def start(self):
+        if self._tasks:
+            return
+        self._closing = False
+        self._queues = [asyncio.Queue(maxsize=self.depth) for _ in range(self.lanes)]
+        self._tasks = [asyncio.create_task(self._worker(lane)) for lane in range(self.lanes)]
+        for lane in range(self.lanes):
+            LANE_DEPTH.set(0, lane=str(lane))
+
+    async def close(self, timeout=10):
+        # Новые апдейты больше не принимаем, уже принятые дорабатываем
+        self._closing = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            left = sum(queue.qsize() for queue in self._queues)
+            logging.warning(f"Webhook lanes not drained in {timeout}s, dropping {left} updates")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def size(self):
+        return sum(queue.qsize() for queue in self._queues)
+
+    def _lane(self, update):
+        try:
+            user = getattr(update.event, 'from_user', None)
+        except Exception:
+            # Неизвестный тип апдейта — шардируем по update_id
+            user = None
+        key = user.id if user is not None else update.update_id
+        return key % self.lanes
+
+    async def handle(self, request):
+        if self._closing or not self._tasks:
+            return web.Response(status=503)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.error(f"Invalid webhook payload: {e}")
+            return web.Response(status=400)
+        lane = self._lane(update)
+        queue = self._queues[lane]
+        if self.should_shed is not None and self.should_shed(update, queue.qsize()):
+            if self.on_shed is not None:
+                asyncio.create_task(self.on_shed(update))
+            return web.Response()
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            LANE_REJECTED.inc()
+            logging.warning(f"Webhook lane {lane} full ({self.depth}), rejecting update {update.update_id}")
+            return web.Response(status=503)
+        LANE_DEPTH.set(queue.qsize(), lane=str(lane))
+        return web.Response()
+
+    async def _worker(self, lane):
+        queue = self._queues[lane]
+        while True:
+            update = await queue.get()
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception as e:
+                logging.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                queue.task_done()
+                LANE_DEPTH.set(queue.qsize(), lane=str(lane))